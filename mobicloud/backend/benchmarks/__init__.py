@@ -0,0 +1,7 @@
+"""
+Benchmarks for the Quill backend
+
+Run the modules from the mobicloud directory, e.g.::
+
+    python -m backend.benchmarks.page_reader
+"""
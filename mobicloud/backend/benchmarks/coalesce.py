@@ -0,0 +1,45 @@
+"""
+Before/after timings of path coalescing in CairoContext
+
+Walks every page of testing-notes/*.note layer by layer (draw_layers)
+at the display_note size, once stroking each segment separately
+(coalesce=False) and once with same-style primitives merged into
+single paths (coalesce=True), and prints the totals over all pages.
+"""
+
+import glob
+import os
+
+from backend.benchmarks.page_reader import NOTES_DIR, best_of
+from backend.cairo_context import CairoContext
+from backend.quill_import import QuillImporter
+
+WIDTH = 410
+HEIGHT = 547
+
+
+def render(page, coalesce):
+    ctr = CairoContext(None, WIDTH, HEIGHT, page, coalesce=coalesce)
+    ctr.draw_layers()
+    ctr._surface.flush()
+
+
+def main(repeat=5):
+    print('%-16s %4s %12s %12s %8s' % ('note', 'page', 'segments ms', 'paths ms', 'speedup'))
+    total_before = total_after = 0.0
+    for filename in sorted(glob.glob(os.path.join(NOTES_DIR, '*.note'))):
+        with QuillImporter(filename) as importer:
+            pages = [importer.get_page(n) for n in range(importer.n_pages())]
+        for n, page in enumerate(pages):
+            before = best_of(lambda: render(page, False), repeat)
+            after = best_of(lambda: render(page, True), repeat)
+            print('%-16s %4d %12.2f %12.2f %7.1fx' % (os.path.basename(filename), n,
+                before * 1000, after * 1000, before / after))
+            total_before += before
+            total_after += after
+    print('%-21s %12.2f %12.2f %7.1fx' % ('total', total_before * 1000, total_after * 1000,
+        total_before / total_after))
+
+
+if __name__ == '__main__':
+    main()
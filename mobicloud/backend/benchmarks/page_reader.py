@@ -0,0 +1,81 @@
+"""
+Microbenchmark of the page decoder
+
+Compares the memoryview cursor (PageReader over the whole page member)
+against the previous approach of reading every field from the tarfile
+member with fp.read(n) and struct.unpack on a format string.
+"""
+
+import glob
+import os
+import struct
+import tarfile
+import time
+
+from backend.quill_import import QuillImporter, QuillPage, QuillBlob
+from backend.page_reader import SHORT
+
+NOTES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'testing-notes')
+
+
+class StreamReader(object):
+    """
+    The old way: one buffered read and one format parse per field
+    """
+    def __init__(self, fp):
+        self._fp = fp
+
+    def unpack(self, layout):
+        return struct.unpack(layout.format, self._fp.read(layout.size))
+
+    def view(self, n):
+        return self._fp.read(n)
+
+    read = view
+
+    def skip(self, n):
+        self._fp.read(n)
+
+    def string(self):
+        nbytes = self.unpack(SHORT)
+        return self._fp.read(nbytes[0]).decode('utf-8')
+
+
+def best_of(func, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_note(filename, repeat):
+    importer = QuillImporter(filename)
+    results = []
+    for n, page_filename in enumerate(importer._page_filenames):
+        def stream():
+            with tarfile.open(filename, 'r') as t:
+                QuillPage(StreamReader(t.extractfile(page_filename)), QuillBlob(importer._archive))
+
+        def cursor():
+            importer.get_page(n)
+
+        results.append((n, best_of(stream, repeat), best_of(cursor, repeat)))
+    importer.close()
+    return results
+
+
+def main(repeat=5):
+    print('%-16s %4s %12s %12s %8s' % ('note', 'page', 'stream ms', 'cursor ms', 'speedup'))
+    for filename in sorted(glob.glob(os.path.join(NOTES_DIR, '*.note'))):
+        results = bench_note(filename, repeat)
+        for n, stream, cursor in results:
+            print('%-16s %4d %12.2f %12.2f %7.1fx' % (os.path.basename(filename), n,
+                stream * 1000, cursor * 1000, stream / cursor))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,339 @@
+"""
+Stage timings of the note pipeline, with stored baselines
+
+Times, for each note, opening the archive, parsing the index, parsing
+the pages, building the page sidecar and loading the pages from it,
+every CairoContext.draw_* layer, drawing the whole page from its
+display list, PNG encoding, and the display_note and page image views
+through the Django test client. Every stage is the best of several runs
+with the render caches emptied, summed over the pages.
+
+The notes are the ones in testing-notes/, larger notebooks built by
+cloning their pages, and synthetic notebooks written by
+backend.synthetic_notes. The views only serve notes from testing-notes/,
+so they are not timed on the others.
+
+    python -m backend.benchmarks.suite --save baseline.json
+    python -m backend.benchmarks.suite --compare baseline.json
+
+With --compare, the run exits with status 1 if a stage got slower than
+the baseline by more than the threshold.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+
+from backend.benchmarks.page_reader import NOTES_DIR
+from backend.cairo_context import CairoContext, image_surface_cache
+from backend.page_reader import INDEX_HEADER, INT, SHORT
+from backend.page_sidecar import PageSidecar, archive_digest, build_sidecar, sidecar_path
+from backend.quill_import import QuillArchive, QuillBlob, QuillIndex, QuillImporter, QuillPage
+from backend.synthetic_notes import generate_notebook
+from backend.text_layout import layout_cache
+
+FORMAT_VERSION = 1
+
+# The notes of testing-notes/ that are benchmarked
+NOTES = ('demo', 'landscape', 'test1', 'test2')
+
+# Notes cloned into larger notebooks: (note, copies of every page)
+LARGE_NOTES = (('demo', 25), ('test1', 50))
+
+# Generated notebooks: (name, options of generate_notebook)
+SYNTHETIC_NOTES = (
+    ('synthetic-dense', dict(pages=20, strokes=300, points=150, shapes=10, words=400, images=1)),
+)
+
+WIDTH = 410
+HEIGHT = 547
+
+# The layers drawn by CairoContext.draw_layers(), in that order
+DRAW_PHASES = ('draw_oval', 'draw_image', 'draw_triangle', 'draw_line',
+               'draw_textBox', 'draw_rectangle', 'draw_table', 'draw_stroke')
+
+# Fraction by which a stage may be slower than its baseline
+THRESHOLD = 0.25
+
+# Differences below this many seconds are noise whatever the ratio
+NOISE_FLOOR = 0.0005
+
+
+def timed(func, repeat, setup=None):
+    """
+    Return the best time of func over repeat runs, calling setup
+    (untimed) before each of them
+    """
+    best = None
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def clear_render_caches():
+    image_surface_cache.clear()
+    layout_cache.clear()
+
+
+def clone_note(source, dest, copies):
+    """
+    Write to dest a notebook holding copies of every page of source,
+    each copy with its own page uuid, listed in a rewritten index
+    """
+    with tarfile.open(source, 'r') as src:
+        members = [m for m in src.getmembers() if m.isfile()]
+        index_member = [m for m in members if m.name.endswith('index') and not m.name.endswith('auto_index')][0]
+        index_data = src.extractfile(index_member).read()
+        index = QuillIndex(index_data)
+        notebook_dir = os.path.split(index_member.name)[0]
+        page_names = set(notebook_dir + '/page_' + u.decode('utf-8') + '.page' for u in index.page_uuids)
+
+        version, npages = INDEX_HEADER.unpack_from(index_data)
+        entry = SHORT.size + 36
+        rest = index_data[INDEX_HEADER.size + npages * entry:]
+        new_uuids = []
+        pages = []
+        for k in range(copies):
+            for u in index.page_uuids:
+                data = src.extractfile(notebook_dir + '/page_' + u.decode('utf-8') + '.page').read()
+                new_uuid = str(uuid.uuid4()).encode('utf-8')
+                if INT.unpack_from(data)[0] >= 4:
+                    # The page record starts with its version and its uuid
+                    data = data[:6] + new_uuid + data[42:]
+                new_uuids.append(new_uuid)
+                pages.append((new_uuid, data))
+
+        new_index = bytearray(INDEX_HEADER.pack(version, len(new_uuids)))
+        for u in new_uuids:
+            new_index += SHORT.pack(36) + u
+        new_index += rest
+
+        with tarfile.open(dest, 'w') as out:
+            def add(name, data):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                out.addfile(info, io.BytesIO(data))
+
+            add(index_member.name, bytes(new_index))
+            for u, data in pages:
+                add(notebook_dir + '/page_' + u.decode('utf-8') + '.page', data)
+            for m in members:
+                if m.name != index_member.name and m.name not in page_names:
+                    out.addfile(m, src.extractfile(m))
+
+
+def bench_parse(filename, repeat):
+    results = OrderedDict()
+    results['open'] = timed(lambda: QuillArchive(filename).close(), repeat)
+    with QuillImporter(filename) as importer:
+        archive = importer._archive
+        index_names = [n for n in archive.names() if n.endswith('index') and not n.endswith('auto_index')]
+        if index_names:
+            index_data = archive.read(index_names[0])
+            results['index_parse'] = timed(lambda: QuillIndex(index_data), repeat)
+        total = 0.0
+        for name in importer._page_filenames:
+            data = archive.read(name)
+            total += timed(lambda: QuillPage(data, QuillBlob(archive)), repeat)
+        results['page_parse'] = total
+    return results
+
+
+def bench_sidecar(filename, repeat, cache_dir):
+    results = OrderedDict()
+    digest = archive_digest(filename)
+    path = sidecar_path(filename, digest, cache_dir)
+    results['sidecar_build'] = timed(lambda: build_sidecar(filename, path, digest), repeat)
+
+    def load():
+        sidecar = PageSidecar(path, filename)
+        for n in range(sidecar.n_pages()):
+            sidecar.get_page(n)
+    results['sidecar_load'] = timed(load, repeat)
+    return results
+
+
+def bench_draw(filename, repeat):
+    results = OrderedDict((name, 0.0) for name in DRAW_PHASES + ('draw_page', 'png_encode'))
+    with QuillImporter(filename) as importer:
+        pages = [importer.get_page(n) for n in range(importer.n_pages())]
+    state = {}
+
+    for page in pages:
+        for phase in DRAW_PHASES:
+            def setup():
+                clear_render_caches()
+                state['ctr'] = CairoContext(None, WIDTH, HEIGHT, page)
+                state['ctr'].init_page()
+
+            results[phase] += timed(lambda: getattr(state['ctr'], phase)(), repeat, setup)
+
+        def setup_page():
+            clear_render_caches()
+            page.__dict__.pop('_display_lists', None)
+            state['ctr'] = CairoContext(None, WIDTH, HEIGHT, page)
+
+        results['draw_page'] += timed(lambda: state['ctr'].draw_page(), repeat, setup_page)
+
+        def setup_encode():
+            state['ctr'] = CairoContext(None, WIDTH, HEIGHT, page)
+            state['ctr'].draw_page()
+
+        results['png_encode'] += timed(lambda: state['ctr'].write_to_buff(io.BytesIO()), repeat, setup_encode)
+    return results
+
+
+def django_client():
+    """
+    Return a Django test client for the project, whose root is the
+    parent of the mobicloud directory
+    """
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))))
+    if root not in sys.path:
+        sys.path.append(root)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mobicloud.settings')
+    import django
+    from django.test import Client
+    from django.test.utils import setup_test_environment
+    django.setup()
+    setup_test_environment()
+    return Client()
+
+
+def bench_views(client, note, n_pages, repeat):
+    from django.urls import reverse
+    from note import views
+
+    def setup():
+        clear_render_caches()
+        views.render_cache.clear()
+        views.page_cache.clear()
+
+    results = OrderedDict((('view_display_note', 0.0), ('view_page_image', 0.0)))
+    for n in range(n_pages):
+        for stage, name in (('view_display_note', 'note-page-display'), ('view_page_image', 'note-page-image')):
+            url = reverse(name, args=(note, n))
+            results[stage] += timed(lambda: client.get(url, HTTP_ACCEPT='image/png'), repeat, setup)
+    return results
+
+
+def run(repeat=5, views=True):
+    """
+    Return the stage timings as {note: {stage: seconds}}
+    """
+    results = OrderedDict()
+    client = django_client() if views else None
+    tmpdir = tempfile.mkdtemp()
+    try:
+        notes = [(note + '.note', os.path.join(NOTES_DIR, note + '.note'), True) for note in NOTES]
+        for note, copies in LARGE_NOTES:
+            name = '%s-x%d.note' % (note, copies)
+            dest = os.path.join(tmpdir, name)
+            clone_note(os.path.join(NOTES_DIR, note + '.note'), dest, copies)
+            notes.append((name, dest, False))
+        for note, options in SYNTHETIC_NOTES:
+            dest = os.path.join(tmpdir, note + '.note')
+            generate_notebook(dest, **options)
+            notes.append((note + '.note', dest, False))
+
+        for name, filename, stock in notes:
+            stages = bench_parse(filename, repeat)
+            stages.update(bench_sidecar(filename, repeat, tmpdir))
+            stages.update(bench_draw(filename, repeat))
+            if client is not None and stock:
+                with QuillImporter(filename) as importer:
+                    n_pages = importer.n_pages()
+                stages.update(bench_views(client, name[:-len('.note')], n_pages, repeat))
+            results[name] = stages
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def save(results, path, repeat):
+    with open(path, 'w') as f:
+        json.dump({
+            'version': FORMAT_VERSION,
+            'python': platform.python_version(),
+            'repeat': repeat,
+            'results': results,
+        }, f, indent=2)
+
+
+def load(path):
+    with open(path) as f:
+        baseline = json.load(f)
+    if baseline.get('version') != FORMAT_VERSION:
+        raise ValueError('baseline ' + path + ' has an unsupported format')
+    return baseline['results']
+
+
+def regressions(results, baseline, threshold=THRESHOLD):
+    """
+    Return (note, stage, seconds, baseline seconds) for the stages
+    slower than their baseline by more than threshold
+    """
+    slower = []
+    for note, stages in results.items():
+        for stage, seconds in stages.items():
+            before = baseline.get(note, {}).get(stage)
+            if before is None:
+                continue
+            if seconds > before * (1 + threshold) and seconds - before > NOISE_FLOOR:
+                slower.append((note, stage, seconds, before))
+    return slower
+
+
+def report(results, baseline=None):
+    print('%-18s %-18s %12s %12s %8s' % ('note', 'stage', 'ms', 'baseline ms', 'change'))
+    for note, stages in results.items():
+        for stage, seconds in stages.items():
+            before = (baseline or {}).get(note, {}).get(stage)
+            if before:
+                print('%-18s %-18s %12.2f %12.2f %+7.0f%%' % (note, stage, seconds * 1000,
+                    before * 1000, (seconds / before - 1) * 100))
+            else:
+                print('%-18s %-18s %12.2f' % (note, stage, seconds * 1000))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the stages of the note pipeline.')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per stage, the best one counts')
+    parser.add_argument('--save', metavar='JSON', help='write the timings to a baseline file')
+    parser.add_argument('--compare', metavar='JSON', help='fail on regressions against a baseline file')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='allowed slowdown as a fraction of the baseline (default %(default)s)')
+    parser.add_argument('--no-views', action='store_true', help='do not time the Django views')
+    args = parser.parse_args(argv)
+
+    results = run(args.repeat, views=not args.no_views)
+    baseline = load(args.compare) if args.compare else None
+    report(results, baseline)
+    if args.save:
+        save(results, args.save, args.repeat)
+    if baseline is not None:
+        slower = regressions(results, baseline, args.threshold)
+        for note, stage, seconds, before in slower:
+            print('regression: %s %s %.2f ms (baseline %.2f ms)' % (note, stage, seconds * 1000, before * 1000))
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,27 +1,138 @@
 import cairo
 import gi
+import itertools
 import math
+import operator
 import os
 
 gi.require_version('Gtk','3.0')
 from gi.repository import GdkPixbuf
 from gi.repository import Gdk as gdk
 from quill_import import QuillImporter
+from backend.lru_cache import SizedLRUCache
+from backend.display_list import get_display_list, PATH, OVAL, IMAGE, TEXTBOX
+from backend.text_layout import layout_text
+from backend.instrumentation import stage, staged, count, debug
+
+# Upper bound, in bytes, of the decoded image surfaces kept in memory
+IMAGE_SURFACE_CACHE_BYTES = 64 * 1024 * 1024
+
+def surface_size(surface):
+	return surface.get_stride() * surface.get_height()
+
+# Decoded images keyed by the digest of their JPEG data, so the same
+# picture is decoded once whichever page or notebook it comes from
+image_surface_cache = SizedLRUCache(IMAGE_SURFACE_CACHE_BYTES, sizeof=surface_size)
+
+# Stage and counter name of the primitives of each display list layer,
+# timed as 'draw_<name>' and counted as '<name>_ops' by replay()
+LAYER_NAMES = {
+	'ovals': 'oval',
+	'images': 'image',
+	'triangles': 'triangle',
+	'lines': 'line',
+	'textboxes': 'textbox',
+	'rectangles': 'rectangle',
+	'tables': 'table',
+	'strokes': 'stroke',
+}
+
+# Size of the pieces a mapped image blob is handed to the JPEG loader in
+IMAGE_WRITE_CHUNK = 64 * 1024
+
+# Largest distance, in device pixels, a stroke may move when simplified
+LOD_TOLERANCE_PIXELS = 0.5
+
+# Edge of the square tiles served for zoomable pages, in pixels
+TILE_SIZE = 256
+
+# Output formats CairoContext can write, and their media types
+SURFACE_KINDS = ('png','svg','pdf')
+CONTENT_TYPES = {
+	'png': 'image/png',
+	'svg': 'image/svg+xml',
+	'pdf': 'application/pdf',
+}
+
+# Rough encoded sizes used to choose between PNG and SVG: a mostly white
+# page compresses to a fraction of a byte per pixel, while SVG pays for
+# every path point, primitive and glyph it writes out
+PNG_BYTES_PER_PIXEL = 0.12
+SVG_BYTES_PER_POINT = 18
+SVG_BYTES_PER_PRIMITIVE = 120
+SVG_BYTES_PER_CHARACTER = 80
+
+def estimate_sizes(quillpage,width,height):
+	"""
+	Return the estimated (png, svg) sizes in bytes of the page drawn
+	at width x height pixels
+	"""
+	points = sum(stroke.n_points() for stroke in quillpage.strokes)
+	primitives = (len(quillpage.strokes) + len(quillpage.lines) + len(quillpage.rectangles) +
+		len(quillpage.ovals) + len(quillpage.triangles) + len(quillpage.tables) + len(quillpage.textboxes))
+	characters = sum(len(textbox.textStr()) for textbox in quillpage.textboxes)
+	png = width * height * PNG_BYTES_PER_PIXEL
+	svg = points * SVG_BYTES_PER_POINT + primitives * SVG_BYTES_PER_PRIMITIVE + characters * SVG_BYTES_PER_CHARACTER
+	return png,svg
+
+def preferred_kind(quillpage,width,height):
+	"""
+	Return 'svg' if the page is sparse enough for vector output to be
+	smaller than a PNG of width x height pixels, else 'png'
+	"""
+	if len(quillpage.images) > 0:
+		# Pictures would be embedded as bitmaps in the SVG anyway
+		return 'png'
+	png,svg = estimate_sizes(quillpage,width,height)
+	if svg < png:
+		return 'svg'
+	return 'png'
 
 class CairoContext(object):
 
-	def __init__(self,dest,width,height,quillpage):
+	def __init__(self,dest,width,height,quillpage,coalesce=True,lod=True,surface=None,kind='png'):
+		"""
+		kind is one of SURFACE_KINDS. A png is drawn into memory and
+		written to dest by write_to_buff(); an svg or pdf is written to
+		dest as it is drawn and completed by write_to_buff(). Strokes
+		are never simplified in vector output, as it can be zoomed.
+
+		If surface is given, drawing goes to that existing surface
+		instead of a new one, e.g. to draw several pages with
+		draw_cell().
+
+		With coalesce=True, consecutive primitives drawn with the same
+		colour and line width are collected into one path and stroked
+		once, and a stroke without pressure is a single polyline.
+		coalesce=False strokes every segment on its own.
+
+		With lod=True, draw_page() and draw_tile() simplify strokes to
+		the detail the output can show (see LOD_TOLERANCE_PIXELS).
+		"""
+		if kind not in SURFACE_KINDS:
+			raise ValueError('unknown surface kind ' + repr(kind))
+		self._kind = kind
+		self._coalesce = coalesce
+		self._lod = lod and kind == 'png'
+		self._style = None
 		self._width = width 
 		self._height = height
 		self._quillpage = quillpage
-		if quillpage.aspect_ratio > 1:
-			self._height,self._width = self._width, self._height
-		self._surface = cairo.ImageSurface(cairo.FORMAT_RGB24,self._width,self._height)
-		#self._surface = cairo.SVGSurface(dest,width,height)
+		if surface is not None:
+			self._surface = surface
+		else:
+			if quillpage.aspect_ratio > 1:
+				self._height,self._width = self._width, self._height
+			if kind == 'svg':
+				self._surface = cairo.SVGSurface(dest,self._width,self._height)
+			elif kind == 'pdf':
+				self._surface = cairo.PDFSurface(dest,self._width,self._height)
+			else:
+				self._surface = cairo.ImageSurface(cairo.FORMAT_RGB24,self._width,self._height)
 		self._context = cairo.Context(self._surface)
 		self._pen_scale_factor = float(5.0/0.003)
 	
-	def init_page(self):
+	def init_page(self,x=0,y=0):
 		self._context.set_line_cap(cairo.LINE_CAP_ROUND)
 		self._context.set_line_join(cairo.LINE_JOIN_ROUND)
 		h = self._height
@@ -30,7 +141,7 @@ class CairoContext(object):
 			w = self._width
 			h = w / self._quillpage.aspect_ratio
 		self._context.identity_matrix() 
-		
+		self._context.translate(x,y)
 		self._context.scale(h,h)
 		#dx = (self._width - w) / h
 		#dy = (self._height - h) / h
@@ -42,22 +153,55 @@ class CairoContext(object):
 		#self._context.stroke()
 		self._context.fill()
 
+	@property
+	def kind(self):
+		return self._kind
+
+	def content_type(self):
+		return CONTENT_TYPES[self._kind]
+
 	def write_image(self,response):
-		self._surface.write_to_png(response)
-		return response
+		return self.write_to_buff(response)
 
+	@staged('encode')
 	def write_to_buff(self,dest):
-		self._surface.write_to_png(dest)
+		"""
+		Write a png to dest, or finish writing a vector surface to the
+		dest it was created with (which should be the same one)
+		"""
+		if self._kind == 'png':
+			self._surface.write_to_png(dest)
+		else:
+			self._surface.finish()
 		return dest
 
+	@staged('draw_image')
 	def draw_image(self):
-		list_images = self._quillpage.images
+		list_images = self._cull('images')
 		if (len(list_images) > 0):
-			ctr = self._context
 			for image in list_images:
-				data = image.data()
+				self._paint_image(image)
+
+	def _image_surface(self,image):
+		"""
+		Return the decoded image as an ARGB32 surface, shared by every
+		image with the same content
+		"""
+		key = image.digest()
+		image_surface = image_surface_cache.get(key)
+		if image_surface is None:
+			data = image.data()
+			count('image_bytes',len(data))
+			with stage('image_decode'):
 				loader = GdkPixbuf.PixbufLoader.new_with_type('jpeg')
-				loader.write(data)
+				if isinstance(data,bytes):
+					loader.write(data)
+				else:
+					# PyGObject only takes bytes for the buffer, and a view of the
+					# mapped archive would be converted item by item. Copy it in
+					# chunks rather than making a second copy of the whole blob.
+					for start in range(0,len(data),IMAGE_WRITE_CHUNK):
+						loader.write(bytes(data[start:start + IMAGE_WRITE_CHUNK]))
 				pixbuf = loader.get_pixbuf()
 				loader.close()
 				# Create image surface
@@ -65,50 +209,120 @@ class CairoContext(object):
 				image_context = cairo.Context(image_surface)
 				gdk.cairo_set_source_pixbuf(image_context,pixbuf,0,0)
 				image_context.paint()
-				image_context.stroke()
-				ctr.save()
-
-				ctr.translate(image.x0(),image.y0())
-				w = (image.x1() - image.x0()) / image_surface.get_width()
-				h = (image.y1() - image.y0()) / image_surface.get_height()
-				ctr.scale(w,h)
-				ctr.set_source_surface(image_surface,0,0)
-				ctr.paint()
-				ctr.stroke()
-				ctr.restore()
+				image_surface.flush()
+			image_surface_cache.put(key,image_surface)
+		return image_surface
+
+	def _paint_image(self,image):
+		ctr = self._context
+		image_surface = self._image_surface(image)
+		ctr.save()
+
+		ctr.translate(image.x0(),image.y0())
+		w = (image.x1() - image.x0()) / image_surface.get_width()
+		h = (image.y1() - image.y0()) / image_surface.get_height()
+		ctr.scale(w,h)
+		ctr.set_source_surface(image_surface,0,0)
+		ctr.paint()
+		ctr.stroke()
+		ctr.restore()
+
+	def _clip_area(self):
+		"""
+		Return the clip rectangle in page units, or None if the clip
+		covers the whole page
+		"""
+		x0,y0,x1,y1 = self._context.clip_extents()
+		if x0 <= 0 and y0 <= 0 and x1 >= self._quillpage.aspect_ratio and y1 >= 1:
+			return None
+		return (x0,y0,x1,y1)
+
+	def _lod_tolerance(self):
+		"""
+		Return the stroke simplification tolerance in page units for
+		the current transformation, or None if it is disabled
+		"""
+		if not self._lod:
+			return None
+		dx,dy = self._context.user_to_device_distance(1,0)
+		return LOD_TOLERANCE_PIXELS / math.hypot(dx,dy)
+
+	def _cull(self,name):
+		"""
+		Return the primitives of the given page section that meet the
+		current clip
+		"""
+		items = getattr(self._quillpage,name)
+		area = self._clip_area()
+		if area is None or len(items) == 0:
+			return items
+		return [items[i] for section,i in self._quillpage.spatial_index().query(area) if section == name]
+
+	def _begin_path(self,rgb,width):
+		"""
+		Set the style for the next primitive. When coalescing, the
+		pending path is only stroked if the style differs.
+		"""
+		style = (rgb[0],rgb[1],rgb[2],width)
+		if style != self._style:
+			self._end_path()
+			self._context.set_source_rgb(rgb[0],rgb[1],rgb[2])
+			self._context.set_line_width(width)
+			self._style = style
+
+	def _end_primitive(self):
+		if not self._coalesce:
+			self._end_path()
 
+	def _end_path(self):
+		if self._style is not None:
+			self._context.stroke()
+			self._style = None
+
+	@staged('draw_stroke')
 	def draw_stroke(self):
-		list_strokes = self._quillpage.strokes
+		list_strokes = self._cull('strokes')
 		if (len(list_strokes) > 0):
 			ctr = self._context
+			segments = 0
 			for stroke in list_strokes:
 				rgb = stroke.rgb()
-				ctr.set_source_rgb(rgb[0]/255,rgb[1]/255,rgb[2]/255)
-				if stroke.has_pressure():
-					p1 = stroke.get_point(0)
-					for i in range(stroke.n_points() - 1):
-						p0 = p1
-						p1 = stroke.get_point(i+1)
-						ctr.set_line_width(stroke.thickness() / self._pen_scale_factor * (p0[2] + p1[2])/2)
-						ctr.move_to(p0[0],p0[1])
-						ctr.line_to(p1[0],p1[1])
-						ctr.stroke()
-				else:
-					ctr.set_line_width(stroke.thickness() / self._pen_scale_factor)
-					p1 = stroke.get_point(0)
-					for i in range(stroke.n_points() - 1):
-						p0 = p1
-						p1 = stroke.get_point(i+1)
-						ctr.move_to(p0[0],p0[1])
-						ctr.line_to(p1[0],p1[1])
-						ctr.stroke()
+				rgb = (rgb[0]/255,rgb[1]/255,rgb[2]/255)
+				points = stroke.points()
+				segments += max(len(points)//3 - 1,0)
+				if stroke.has_pressure() or not self._coalesce:
+					# The width changes along the stroke, so the path is
+					# split wherever the width of the next segment differs
+					scale = stroke.thickness() / self._pen_scale_factor
+					pressure = stroke.has_pressure()
+					self._end_path()
+					for i in range(3,len(points),3):
+						if pressure:
+							width = scale * (points[i-1] + points[i+2])/2
+						else:
+							width = scale
+						if (rgb[0],rgb[1],rgb[2],width) != self._style:
+							self._begin_path(rgb,width)
+							ctr.move_to(points[i-3],points[i-2])
+						ctr.line_to(points[i],points[i+1])
+						self._end_primitive()
+					# Start the next stroke with a fresh sub-path
+					self._end_path()
+				elif len(points) >= 6:
+					self._begin_path(rgb,stroke.thickness() / self._pen_scale_factor)
+					ctr.move_to(points[0],points[1])
+					for i in range(3,len(points),3):
+						ctr.line_to(points[i],points[i+1])
+			self._end_path()
+			count('segments',segments)
 
+	@staged('draw_table')
 	def draw_table(self):
-		list_tables = self._quillpage.tables
+		list_tables = self._cull('tables')
 		if (len(list_tables) > 0):
 			ctr = self._context
 			for table in list_tables:
-				print(table)
+				debug('%r',table)
 				ctr.set_line_width(table.thickness() / self._pen_scale_factor)
 				rgb = table.rgb()
 				ctr.set_source_rgb(rgb[0],rgb[1],rgb[2])
@@ -129,134 +343,206 @@ class CairoContext(object):
 					ctr.line_to(table.left() + innerCol, table.bottom())
 				ctr.stroke()
 
+	@staged('draw_oval')
 	def draw_oval(self):
-		list_ovals = self._quillpage.ovals
+		list_ovals = self._cull('ovals')
 		if (len(list_ovals) > 0):
 			ctr = self._context
 			for oval in list_ovals:
-				ctr.set_line_width(oval.thickness() / self._pen_scale_factor)
-				rgb = oval.rgb()
-				ctr.set_source_rgb(rgb[0],rgb[1],rgb[2])
 				center_x,center_y = oval.center_coordinate()
 				factor = (center_y - oval.top()) / (center_x - oval.left()) 
-				ctr.scale(1,factor)
-				ctr.arc(center_x,center_y/factor,center_x - oval.left(),0,2*math.pi)
-				ctr.stroke()
-				#rescale
-				ctr.scale(1,1/factor)
+				self._stroke_oval(oval.rgb(),oval.thickness() / self._pen_scale_factor,center_x,center_y,center_x - oval.left(),factor)
 
+	def _stroke_oval(self,rgb,width,center_x,center_y,radius,factor):
+		ctr = self._context
+		ctr.set_line_width(width)
+		ctr.set_source_rgb(rgb[0],rgb[1],rgb[2])
+		ctr.scale(1,factor)
+		ctr.arc(center_x,center_y/factor,radius,0,2*math.pi)
+		ctr.stroke()
+		#rescale
+		ctr.scale(1,1/factor)
+
+	@staged('draw_rectangle')
 	def draw_rectangle(self):
-		list_rectangles = self._quillpage.rectangles
+		list_rectangles = self._cull('rectangles')
 		if (len(list_rectangles) > 0):
 			ctr = self._context
 			for rectangle in list_rectangles:
-				ctr.set_line_width(rectangle.thickness() / self._pen_scale_factor)
-				rgb = rectangle.rgb()
-				ctr.set_source_rgb(rgb[0],rgb[1],rgb[2])
+				self._begin_path(rectangle.rgb(),rectangle.thickness() / self._pen_scale_factor)
 				ctr.rectangle(rectangle.left(),rectangle.top(),rectangle.width(),rectangle.height())
-				ctr.stroke()
+				self._end_primitive()
+			self._end_path()
 
+	@staged('draw_triangle')
 	def draw_triangle(self):
-		list_triangles = self._quillpage.triangles
+		list_triangles = self._cull('triangles')
 		if len(list_triangles) > 0:
 			ctr = self._context
 			for triangle in list_triangles:
-				ctr.set_line_width(triangle.thickness() / self._pen_scale_factor)
-				rgb = triangle.rgb()
-				ctr.set_source_rgb(rgb[0],rgb[1],rgb[2])
+				self._begin_path(triangle.rgb(),triangle.thickness() / self._pen_scale_factor)
 				ctr.move_to(triangle.middle(),triangle.top())
 				ctr.line_to(triangle.left(),triangle.bottom())
 				ctr.line_to(triangle.right(),triangle.bottom())
 				ctr.line_to(triangle.middle(),triangle.top())
-				ctr.stroke()
+				self._end_primitive()
+			self._end_path()
 
+	@staged('draw_line')
 	def draw_line(self):
-		list_lines = self._quillpage.lines
+		list_lines = self._cull('lines')
 		if len(list_lines) > 0:
 			ctr = self._context
 			for line in list_lines:
-				ctr.set_line_width(line.thickness() / self._pen_scale_factor)
-				rgb = line.rgb()
-				ctr.set_source_rgb(rgb[0],rgb[1],rgb[2])
+				self._begin_path(line.rgb(),line.thickness() / self._pen_scale_factor)
 				ctr.move_to(line.x0(), line.y0())
 				ctr.line_to(line.x1(), line.y1())
-				ctr.stroke()
+				self._end_primitive()
+			self._end_path()
 
+	@staged('draw_textbox')
 	def draw_textBox(self):
 		list_textboxes = self._quillpage.textboxes
 		if len(list_textboxes) > 0:
-			ctr = self._context
 			for textbox in list_textboxes:
-				#set surface for the text
-				textbox_width = textbox.right() - textbox.left()
-				textbox_height = textbox.bottom() - textbox.top()
-				spacing_width = (textbox_width/25)
-				spacing_height = (textbox_height/2.5)
-				font_size = textbox.textSize() * textbox.fontScale() / (842*842*.52/self._height)
-				# Take this out after no more bug, leave rectagle now to indicate area of textbox
-				ctr.rectangle(textbox.left(),textbox.top(),textbox_width,textbox_height)
-				ctr.set_source_rgb(0,0,0)
-				ctr.stroke()
+				self._draw_textbox(textbox)
 
-				rgb = textbox.rgb()
-				ctr.set_source_rgb(rgb[0],rgb[1],rgb[2])
-				ctr.set_font_size(font_size)
+	def _draw_textbox(self,textbox):
+		ctr = self._context
+		#set surface for the text
+		textbox_width = textbox.right() - textbox.left()
+		textbox_height = textbox.bottom() - textbox.top()
+		spacing_width = (textbox_width/25)
+		spacing_height = (textbox_height/2.5)
+		font_size = textbox.textSize() * textbox.fontScale() / (842*842*.52/self._height)
+		# Take this out after no more bug, leave rectagle now to indicate area of textbox
+		ctr.rectangle(textbox.left(),textbox.top(),textbox_width,textbox_height)
+		ctr.set_source_rgb(0,0,0)
+		ctr.stroke()
 
-				if textbox.isItalic():
-					format_italic = cairo.FONT_SLANT_ITALIC
-				else:
-					format_italic = cairo.FONT_SLANT_NORMAL
+		rgb = textbox.rgb()
+		ctr.set_source_rgb(rgb[0],rgb[1],rgb[2])
 
-				if textbox.isBold():
-					format_bold = cairo.FONT_WEIGHT_BOLD
-				else:
-					format_bold = cairo.FONT_WEIGHT_NORMAL
-
-				ctr.select_font_face("Arial",format_italic,format_bold)
-				constant_left = textbox.left() + spacing_width
-				
-				nextline = 1
-				validWord = ''
-				attemptWord = ''
-				considered_words=[]
-				list_words = textbox.breakWords()
-				while(True):  
-					if len(list_words) == 0 and len(considered_words) == 0:
-						ctr.move_to(textbox.left() + spacing_width,textbox.top() + nextline * spacing_height)
-						ctr.show_text(validWord)
-						break
-					if len(considered_words) == 0:
-						considered_words.append(list_words.pop(0))
-					
-					currentWord = considered_words.pop(0)
-					if validWord != '':
-						attemptWord = validWord + ' ' + currentWord
-					else:
-						attemptWord = currentWord
-					
-					x_bearing, y_bearing, text_width, text_height, dx, dy = ctr.text_extents(attemptWord)
-					if (textbox_width - text_width >= spacing_width):
-						validWord = attemptWord
-					if (textbox_width - text_width < spacing_width):
-						ctr.move_to(textbox.left() + spacing_width,textbox.top() + nextline * spacing_height)
-						if validWord != '':	
-							considered_words.insert(0,currentWord)
-						else :
-							lastIndex = len(attemptWord)
-							while(True):
-								text_subStr = attemptWord[:lastIndex]
-								x_bearing, y_bearing, text_width, text_height, dx, dy = ctr.text_extents(text_subStr)
-								if (textbox_width - text_width >= spacing_width):
-									validWord = text_subStr
-									considered_words.insert(0,attemptWord[lastIndex:])
-									break
-								lastIndex -= 1
-						ctr.show_text(validWord)
-						nextline += 1
-						validWord = ''
-		
+		if textbox.isItalic():
+			format_italic = cairo.FONT_SLANT_ITALIC
+		else:
+			format_italic = cairo.FONT_SLANT_NORMAL
+
+		if textbox.isBold():
+			format_bold = cairo.FONT_WEIGHT_BOLD
+		else:
+			format_bold = cairo.FONT_WEIGHT_NORMAL
+
+		ctr.select_font_face("Arial",format_italic,format_bold)
+		ctr.set_font_size(font_size)
+		lines = layout_text(ctr,textbox.textStr(),"Arial",format_italic,format_bold,font_size,textbox_width - spacing_width)
+		for nextline,line in enumerate(lines,1):
+			ctr.move_to(textbox.left() + spacing_width,textbox.top() + nextline * spacing_height)
+			ctr.show_text(line)
+
+	def replay(self,display_list,area=None):
+		"""
+		Draw a compiled DisplayList of the page. If area, an (x0, y0, x1,
+		y1) rectangle in page units, is given, only the operations that
+		meet it are drawn.
+
+		Each run of operations of the same layer is timed as the
+		draw_* stage of that layer, and the operations are counted.
+		"""
+		ctr = self._context
+		ops = display_list if area is None else display_list.visible(area)
+		segments = 0
+		for layer,run in itertools.groupby(ops,operator.itemgetter(4)):
+			name = LAYER_NAMES[layer]
+			n = 0
+			with stage('draw_' + name):
+				for kind,rgb,width,geometry,layer in run:
+					n += 1
+					if kind == PATH:
+						self._begin_path(rgb,width)
+						for coords,stride,start,stop,closed in geometry:
+							segments += (stop - start)//stride - 1
+							ctr.move_to(coords[start],coords[start+1])
+							for i in range(start+stride,stop,stride):
+								ctr.line_to(coords[i],coords[i+1])
+							if closed:
+								ctr.close_path()
+						continue
+					self._end_path()
+					if kind == OVAL:
+						self._stroke_oval(rgb,width,*geometry)
+					elif kind == IMAGE:
+						self._paint_image(geometry)
+					elif kind == TEXTBOX:
+						self._draw_textbox(geometry)
+				# Stroke the pending path within the stage of its layer
+				self._end_path()
+			count(name + '_ops',n)
+		count('segments',segments)
 
+	@staged('draw_page')
 	def draw_page(self):
+		"""
+		Draw the whole page from its (cached) display list
+		"""
+		self.init_page()
+		self.replay(get_display_list(self._quillpage,self._lod_tolerance()),self._clip_area())
+
+	@classmethod
+	def tile_grid(cls,quillpage,zoom):
+		"""
+		Return the number of tile columns and rows covering the page
+		at the given zoom level. At zoom 0 the page is one tile high,
+		whatever the tile size.
+		"""
+		rows = 2 ** zoom
+		columns = int(math.ceil(rows * quillpage.aspect_ratio))
+		return columns,rows
+
+	@staged('draw_tile')
+	def draw_tile(self,zoom,x,y,tile_size=TILE_SIZE):
+		"""
+		Draw tile (x, y) of the page at the given zoom level. The context
+		must have been created with width and height equal to tile_size.
+		Only the primitives that meet the tile are drawn.
+		"""
+		ctr = self._context
+		ctr.set_line_cap(cairo.LINE_CAP_ROUND)
+		ctr.set_line_join(cairo.LINE_JOIN_ROUND)
+		ctr.identity_matrix()
+		ctr.set_source_rgb(1,1,1)
+		ctr.paint()
+		ctr.rectangle(0,0,tile_size,tile_size)
+		ctr.clip()
+		scale = tile_size * 2 ** zoom
+		# Text is sized from the height of the whole page in pixels
+		self._height = scale
+		ctr.translate(-x * tile_size,-y * tile_size)
+		ctr.scale(scale,scale)
+		self.replay(get_display_list(self._quillpage,self._lod_tolerance()),self._clip_area())
+
+	def draw_cell(self,quillpage,x,y,width,height):
+		"""
+		Draw quillpage fitted into the width x height cell at (x, y)
+		of the surface, leaving the rest of the surface untouched
+		"""
+		ctr = self._context
+		self._quillpage = quillpage
+		self._width = width
+		self._height = height
+		ctr.save()
+		ctr.reset_clip()
+		ctr.identity_matrix()
+		ctr.rectangle(x,y,width,height)
+		ctr.clip()
+		self.init_page(x,y)
+		self.replay(get_display_list(quillpage,self._lod_tolerance()),self._clip_area())
+		ctr.restore()
+
+	def draw_layers(self):
+		"""
+		Draw the page by walking the QuillPage layer by layer
+		"""
 		self.init_page()
 		self.draw_oval()
 		self.draw_image()
@@ -0,0 +1,66 @@
+"""
+Contact sheet of a notebook
+
+All the pages of a .note are drawn as thumbnails onto one sprite
+image, reading the archive once and reusing a single surface. The
+position of every thumbnail is given by contact_sheet_layout() without
+drawing anything, so a front end can fetch it apart from the sprite and
+slice the sprite with it.
+"""
+
+import io
+import math
+
+import cairo
+
+from backend.cairo_context import CairoContext
+
+# Size of one thumbnail and the gap around it, in pixels
+THUMB_WIDTH = 120
+THUMB_HEIGHT = 160
+PADDING = 8
+COLUMNS = 6
+
+# Colour behind the thumbnails
+BACKGROUND = (0.85, 0.85, 0.85)
+
+
+def contact_sheet_layout(n_pages, thumb_width=THUMB_WIDTH, thumb_height=THUMB_HEIGHT, columns=COLUMNS, padding=PADDING):
+    """
+    Return the width and height of the sprite and a list with, for
+    each page, a dict of its page number and the x, y, width and height
+    of its thumbnail in the sprite.
+    """
+    columns = max(1, min(columns, n_pages))
+    rows = max(1, int(math.ceil(n_pages / float(columns))))
+    width = columns * (thumb_width + padding) + padding
+    height = rows * (thumb_height + padding) + padding
+    thumbnails = []
+    for n in range(n_pages):
+        x = padding + (n % columns) * (thumb_width + padding)
+        y = padding + (n // columns) * (thumb_height + padding)
+        thumbnails.append({'page': n, 'x': x, 'y': y, 'width': thumb_width, 'height': thumb_height})
+    return width, height, thumbnails
+
+
+def render_contact_sheet(importer, thumb_width=THUMB_WIDTH, thumb_height=THUMB_HEIGHT, columns=COLUMNS, padding=PADDING):
+    """
+    Draw every page of the notebook opened by importer into one sprite.
+
+    Return the sprite as PNG bytes and the thumbnail positions, as
+    given by contact_sheet_layout().
+    """
+    width, height, thumbnails = contact_sheet_layout(importer.n_pages(), thumb_width, thumb_height, columns, padding)
+
+    surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+    ctr = cairo.Context(surface)
+    ctr.set_source_rgb(*BACKGROUND)
+    ctr.paint()
+
+    sheet = CairoContext(None, width, height, None, surface=surface)
+    for thumb in thumbnails:
+        sheet.draw_cell(importer.get_page(thumb['page']), thumb['x'], thumb['y'], thumb['width'], thumb['height'])
+
+    buff = io.BytesIO()
+    surface.write_to_png(buff)
+    return buff.getvalue(), thumbnails
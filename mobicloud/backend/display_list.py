@@ -0,0 +1,242 @@
+"""
+Display list of a QuillPage
+
+Compiling walks the page once and turns it into a flat list of draw
+operations in page units (the page is 1 unit high). Colours are
+converted and line widths scaled at compile time, and consecutive
+primitives sharing a style are merged into one path operation, so
+replaying the list onto a cairo context of any size or kind is a tight
+loop. The list is cached on the page, so every render of that page
+(full size, thumbnail, high DPI, ...) shares one compile, or one per
+level of detail when strokes are simplified for the output scale.
+
+The bounding box of every operation, in page units and including half
+the line width, is kept alongside in ``bounds``, so a renderer can skip
+the operations outside the area it draws.
+
+Each operation is a tuple ``(kind, rgb, width, geometry, layer)``, where
+layer is the page section it was compiled from (``'strokes'``,
+``'lines'``, ...), so that a renderer can account for its time per
+section. A path merged across sections keeps the section it started in.
+
+* ``PATH``: geometry is a list of sub-paths ``(coords, stride, start,
+  stop, closed)``; the points are ``coords[i], coords[i+1]`` for
+  ``i in range(start, stop, stride)``
+* ``OVAL``: geometry is ``(center_x, center_y, radius, factor)``
+* ``IMAGE``: geometry is the Image
+* ``TEXTBOX``: geometry is the TextBox; rgb and width are unused
+"""
+
+from backend.spatial_index import GridIndex
+from backend.simplify import tolerance_bucket
+from backend.instrumentation import stage
+
+PATH = 0
+OVAL = 1
+IMAGE = 2
+TEXTBOX = 3
+
+# A line-width of 0.003 gives a good visual approximation to Quill's pen thickness of 5
+PEN_SCALE_FACTOR = float(5.0/0.003)
+
+UNBOUNDED = float('inf')
+
+
+def subpath_bounds(subpath, margin):
+    coords, stride, start, stop, closed = subpath
+    xs = coords[start:stop:stride]
+    ys = coords[start+1:stop:stride]
+    return (min(xs) - margin, min(ys) - margin, max(xs) + margin, max(ys) + margin)
+
+
+def union(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+class DisplayList(object):
+
+    def __init__(self):
+        self._ops = []
+        self.bounds = []
+        self._index = None
+
+    def __len__(self):
+        return len(self._ops)
+
+    def __iter__(self):
+        return iter(self._ops)
+
+    def __getitem__(self, i):
+        return self._ops[i]
+
+    def add_path(self, rgb, width, subpath, layer):
+        """
+        Append a sub-path, extending the previous operation if it is a
+        path with the same style.
+        """
+        ops = self._ops
+        bbox = subpath_bounds(subpath, width / 2)
+        if ops:
+            last = ops[-1]
+            if last[0] == PATH and last[1] == rgb and last[2] == width:
+                last[3].append(subpath)
+                self.bounds[-1] = union(self.bounds[-1], bbox)
+                return
+        ops.append((PATH, rgb, width, [subpath], layer))
+        self.bounds.append(bbox)
+
+    def add(self, kind, rgb, width, geometry, bbox, layer):
+        self._ops.append((kind, rgb, width, geometry, layer))
+        self.bounds.append(bbox)
+
+    def visible(self, area):
+        """
+        Return the operations whose bounding box meets area, an
+        (x0, y0, x1, y1) rectangle in page units, in drawing order
+        """
+        if self._index is None:
+            index = GridIndex()
+            for i, bbox in enumerate(self.bounds):
+                index.insert(i, bbox)
+            self._index = index
+        ops = self._ops
+        return [ops[i] for i in self._index.query(area)]
+
+
+def _raw_rgb(item):
+    # Shapes have always been drawn with their 0-255 components as is
+    rgb = item.rgb()
+    return (rgb[0], rgb[1], rgb[2])
+
+
+def _width(item):
+    return item.thickness() / PEN_SCALE_FACTOR
+
+
+def compile_ovals(dl, ovals):
+    for oval in ovals:
+        center_x, center_y = oval.center_coordinate()
+        factor = (center_y - oval.top()) / (center_x - oval.left())
+        radius = center_x - oval.left()
+        margin = _width(oval) / 2
+        bbox = (center_x - radius - margin, center_y - abs(radius * factor) - margin,
+                center_x + radius + margin, center_y + abs(radius * factor) + margin)
+        dl.add(OVAL, _raw_rgb(oval), _width(oval), (center_x, center_y, radius, factor), bbox, 'ovals')
+
+
+def compile_images(dl, images):
+    for image in images:
+        bbox = (min(image.x0(), image.x1()), min(image.y0(), image.y1()),
+                max(image.x0(), image.x1()), max(image.y0(), image.y1()))
+        dl.add(IMAGE, None, None, image, bbox, 'images')
+
+
+def compile_triangles(dl, triangles):
+    for triangle in triangles:
+        coords = (triangle.middle(), triangle.top(),
+                  triangle.left(), triangle.bottom(),
+                  triangle.right(), triangle.bottom(),
+                  triangle.middle(), triangle.top())
+        dl.add_path(_raw_rgb(triangle), _width(triangle), (coords, 2, 0, 8, False), 'triangles')
+
+
+def compile_lines(dl, lines):
+    for line in lines:
+        coords = (line.x0(), line.y0(), line.x1(), line.y1())
+        dl.add_path(_raw_rgb(line), _width(line), (coords, 2, 0, 4, False), 'lines')
+
+
+def compile_textboxes(dl, textboxes):
+    for textbox in textboxes:
+        # Wrapped text can run past the bottom of its box
+        bbox = (textbox.left(), textbox.top(), textbox.right(), UNBOUNDED)
+        dl.add(TEXTBOX, None, None, textbox, bbox, 'textboxes')
+
+
+def compile_rectangles(dl, rectangles):
+    for rectangle in rectangles:
+        left, top = rectangle.left(), rectangle.top()
+        right, bottom = left + rectangle.width(), top + rectangle.height()
+        coords = (left, top, right, top, right, bottom, left, bottom)
+        dl.add_path(_raw_rgb(rectangle), _width(rectangle), (coords, 2, 0, 8, True), 'rectangles')
+
+
+def compile_tables(dl, tables):
+    for table in tables:
+        rgb = _raw_rgb(table)
+        width = _width(table)
+        left, right, top, bottom = table.left(), table.right(), table.top(), table.bottom()
+        border = (left, top, left, bottom, right, bottom, right, top, left, top)
+        dl.add_path(rgb, width, (border, 2, 0, 10, False), 'tables')
+        for innerRow in table.computeRowLine():
+            coords = (left, top + innerRow, right, top + innerRow)
+            dl.add_path(rgb, width, (coords, 2, 0, 4, False), 'tables')
+        for innerCol in table.computeColLine():
+            coords = (left + innerCol, top, left + innerCol, bottom)
+            dl.add_path(rgb, width, (coords, 2, 0, 4, False), 'tables')
+
+
+def compile_strokes(dl, strokes, bucket=None):
+    for stroke in strokes:
+        rgb = stroke.rgb()
+        rgb = (rgb[0]/255, rgb[1]/255, rgb[2]/255)
+        if bucket is None:
+            points = stroke.points()
+        else:
+            points = stroke.simplified(bucket)
+        n = len(points)
+        if n < 6:
+            continue
+        scale = stroke.thickness() / PEN_SCALE_FACTOR
+        if not stroke.has_pressure():
+            dl.add_path(rgb, scale, (points, 3, 0, n, False), 'strokes')
+            continue
+        # One sub-path per run of segments with the same width
+        start = 0
+        width = scale * (points[2] + points[5])/2
+        for i in range(6, n, 3):
+            w = scale * (points[i-1] + points[i+2])/2
+            if w != width:
+                dl.add_path(rgb, width, (points, 3, start, i, False), 'strokes')
+                start = i - 3
+                width = w
+        dl.add_path(rgb, width, (points, 3, start, n, False), 'strokes')
+
+
+def compile_page(page, bucket=None):
+    """
+    Compile the page into a DisplayList, in the layer order of
+    CairoContext.draw_page(). If a tolerance bucket is given, strokes
+    are simplified to a tolerance of 2**bucket page units.
+    """
+    dl = DisplayList()
+    compile_ovals(dl, page.ovals)
+    compile_images(dl, page.images)
+    compile_triangles(dl, page.triangles)
+    compile_lines(dl, page.lines)
+    compile_textboxes(dl, page.textboxes)
+    compile_rectangles(dl, page.rectangles)
+    compile_tables(dl, page.tables)
+    compile_strokes(dl, page.strokes, bucket)
+    return dl
+
+
+def get_display_list(page, tolerance=None):
+    """
+    Return the display list of the page, compiling it on first use.
+
+    With a tolerance (in page units), strokes are simplified to the
+    power of two just below it, and there is one cached list per power.
+    """
+    bucket = None if tolerance is None else tolerance_bucket(tolerance)
+    lists = getattr(page, '_display_lists', None)
+    if lists is None:
+        lists = page._display_lists = {}
+    dl = lists.get(bucket)
+    if dl is None:
+        with stage('compile'):
+            dl = lists[bucket] = compile_page(page, bucket)
+        grown = getattr(page, 'grown', None)
+        if grown is not None:
+            grown()
+    return dl
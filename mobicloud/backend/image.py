@@ -9,6 +9,7 @@ EXAMPLES::
     image at (0.13,0.605):(0.455,0.739)
 """
 
+import hashlib
 
 
 
@@ -17,7 +18,7 @@ class Image(object):
     Embedded image on a page.
     """
 
-    def __init__(self, uuid, x0, x1, y0, y1, constrain_aspect, jpg_data):
+    def __init__(self, uuid, x0, x1, y0, y1, constrain_aspect, jpg_data, data_loader=None, on_load=None):
         self._uuid = uuid.decode('utf-8')
         self._x0 = x0
         self._x1 = x1
@@ -25,6 +26,9 @@ class Image(object):
         self._y1 = y1
         self._constrain = constrain_aspect
         self._data = jpg_data
+        self._loader = data_loader
+        self._on_load = on_load
+        self._digest = None
 
     def __repr__(self):
         s  = 'image at ('
@@ -44,9 +48,32 @@ class Image(object):
         
             >>> sample_image.data()    # doctest: +ELLIPSIS
             '\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00...
+
+        If the image was created with a ``data_loader``, the data is
+        loaded on the first call and kept afterwards, and ``on_load`` is
+        then called if it was given.
         """
+        if self._data is None and self._loader is not None:
+            self._data = self._loader()
+            self._loader = None
+            if self._on_load is not None:
+                self._on_load()
+                self._on_load = None
         return self._data
     
+    def digest(self):
+        """
+        Return the SHA-1 digest of the image data.
+
+        Identical images in different notebooks (which have different
+        uuids) have the same digest.
+
+        :rtype: bytes
+        """
+        if self._digest is None:
+            self._digest = hashlib.sha1(self.data()).digest()
+        return self._digest
+
     def uuid(self):
         """
         Return the image uuid.
@@ -73,6 +100,15 @@ class Image(object):
         """
         return self._constrain
 
+    def bbox(self):
+        """
+        Return the bounding box (x0, y0, x1, y1).
+
+        :rtype: tuple of floats
+        """
+        return (min(self._x0, self._x1), min(self._y0, self._y1),
+                max(self._x0, self._x1), max(self._y0, self._y1))
+
     def x0(self):
         """
         Return the minimum x-coordinate.
@@ -0,0 +1,199 @@
+"""
+Timings and work counters of the note pipeline
+
+Code wraps its stages in ``with stage('name'):`` (or decorates them
+with ``@staged('name')``) and reports the work done with ``count('name',
+n)``. Every stage duration goes into a process-wide histogram and every
+counter into a process-wide total, which render_metrics() exposes in the
+Prometheus text format. While a Trace is active on the current thread
+(see tracing()), durations and counters are also summed into it, e.g. to
+answer one request with a Server-Timing header.
+
+Diagnostic output goes through debug() to the ``backend`` logger, which
+costs one level check unless debug logging is enabled.
+"""
+
+import bisect
+import functools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger('backend')
+
+# Upper bounds, in seconds, of the histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+METRIC_PREFIX = 'note'
+
+
+class Histogram(object):
+
+    def __init__(self):
+        # One count per bucket, and a last one for the values above them all
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """
+    Thread-safe process-wide stage histograms and work counters
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = OrderedDict()
+        self._counters = OrderedDict()
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self._stages.get(name)
+            if histogram is None:
+                histogram = self._stages[name] = Histogram()
+            histogram.observe(seconds)
+
+    def add(self, name, n):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def clear(self):
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def render(self):
+        """
+        Return the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            name = METRIC_PREFIX + '_stage_seconds'
+            lines.append('# HELP %s Time spent in each stage of the note pipeline.' % name)
+            lines.append('# TYPE %s histogram' % name)
+            for stage_name, histogram in self._stages.items():
+                cumulative = 0
+                for bound, n in zip(BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += n
+                    lines.append('%s_bucket{stage="%s",le="%s"} %d' % (name, stage_name, bound, cumulative))
+                lines.append('%s_sum{stage="%s"} %r' % (name, stage_name, histogram.sum))
+                lines.append('%s_count{stage="%s"} %d' % (name, stage_name, histogram.count))
+            name = METRIC_PREFIX + '_work_total'
+            lines.append('# HELP %s Work done by the note pipeline (points, segments, bytes, ...).' % name)
+            lines.append('# TYPE %s counter' % name)
+            for counter_name, value in self._counters.items():
+                lines.append('%s{counter="%s"} %d' % (name, counter_name, value))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+_local = threading.local()
+
+
+class Trace(object):
+    """
+    Stage durations and counters of one unit of work, e.g. a request
+    """
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+
+    def add_time(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def add_count(self, name, n):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def server_timing(self):
+        """
+        Return the value of a Server-Timing header: the stage durations
+        in milliseconds, then the counters as descriptions
+        """
+        entries = ['%s;dur=%.2f' % (name, seconds * 1000) for name, seconds in self.stages.items()]
+        entries += ['%s;desc="%d"' % (name, n) for name, n in self.counters.items()]
+        return ', '.join(entries)
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def tracing():
+    """
+    Collect the stages and counters of the current thread into a new
+    Trace until the block ends
+    """
+    previous = current_trace()
+    trace = _local.trace = Trace()
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+class stage(object):
+    """
+    Context manager timing a stage of the pipeline
+    """
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        metrics.observe(self.name, elapsed)
+        trace = getattr(_local, 'trace', None)
+        if trace is not None:
+            trace.add_time(self.name, elapsed)
+
+
+def staged(name):
+    """
+    Decorator timing every call of a function as the given stage
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, n=1):
+    """
+    Add n to the work counter with the given name
+    """
+    metrics.add(name, n)
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.add_count(name, n)
+
+
+def debug(message, *args):
+    """
+    Log a diagnostic message, formatted only if debug logging is on
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(message, *args)
+
+
+def render_metrics():
+    return metrics.render()
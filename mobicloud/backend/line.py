@@ -25,6 +25,9 @@ class Line(ColorTool):
 		s += 'y1: ' + str(self._y1) + '\n'
 		return s
 
+	def bbox(self):
+		return (min(self._x0,self._x1),min(self._y0,self._y1),max(self._x0,self._x1),max(self._y0,self._y1))
+
 	def x0(self):
 		return self._x0
 
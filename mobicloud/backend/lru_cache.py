@@ -0,0 +1,101 @@
+"""
+Least-recently-used cache bounded by the total size of its values
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class SizedLRUCache(object):
+    """
+    Thread-safe LRU map whose capacity is a byte budget
+
+    ``sizeof`` gives the (approximate) size of a value in bytes. The
+    least recently used entries are evicted until the total fits in
+    ``max_bytes``. A value bigger than the whole budget is not stored.
+    """
+    def __init__(self, max_bytes, sizeof=len):
+        self._max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self._sizeof(value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            if size > self._max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                evicted_key, (evicted, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def resize(self, key):
+        """
+        Measure the value stored under key again, after it has grown or
+        shrunk, and evict entries if the total is now over the budget
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return
+        size = self._sizeof(entry[0])
+        with self._lock:
+            current = self._entries.get(key)
+            if current is None or current[0] is not entry[0]:
+                return
+            self._bytes += size - current[1]
+            if size > self._max_bytes:
+                del self._entries[key]
+                self._bytes -= size
+                return
+            self._entries[key] = (current[0], size)
+            while self._bytes > self._max_bytes:
+                evicted_key, (evicted, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def stats(self):
+        """
+        Return the counters and current occupancy as a dict
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self._max_bytes,
+            }
@@ -0,0 +1,141 @@
+"""
+Process-wide cache of parsed Quill pages
+
+Pages are keyed by (path, mtime, size, page index) of the archive, so
+rewriting a notebook makes its old entries unreachable. The cache is
+bounded by the approximate memory footprint of the pages rather than
+by their number.
+
+With sidecars enabled, pages missing from the cache are loaded from the
+memory-mapped sidecar of their notebook (see page_sidecar), which is
+built on first use, instead of being parsed from the archive.
+"""
+
+import functools
+import os
+
+from backend.base import QuillImporterError
+from backend.instrumentation import debug
+from backend.lru_cache import SizedLRUCache
+from backend.quill_import import QuillImporter
+from backend.page_sidecar import open_sidecar
+
+
+def page_footprint(page):
+    return page.footprint()
+
+
+class ParsedPageCache(object):
+
+    # Number of page digests remembered apart from the pages themselves,
+    # and of notebooks whose digests are remembered as a whole (page None)
+    max_digests = 4096
+
+    # Number of notebooks whose sidecar is kept open
+    max_sidecars = 64
+
+    def __init__(self, max_bytes, sidecars=False, sidecar_dir=None):
+        """
+        With sidecars=True, pages are loaded from page sidecars kept
+        next to the notebooks, or in sidecar_dir if it is given.
+        """
+        self._pages = SizedLRUCache(max_bytes, sizeof=page_footprint)
+        self._digests = SizedLRUCache(self.max_digests, sizeof=lambda digest: 1)
+        self._sidecars = SizedLRUCache(self.max_sidecars, sizeof=lambda sidecar: 1) if sidecars else None
+        self._sidecar_dir = sidecar_dir
+
+    def _key(self, filename, n):
+        st = os.stat(filename)
+        return (os.path.realpath(filename), st.st_mtime_ns, st.st_size, n)
+
+    def _sidecar(self, key, filename):
+        """
+        Return the open sidecar of the notebook, or None if sidecars are
+        disabled or this one cannot be built
+        """
+        if self._sidecars is None:
+            return None
+        key = key[:-1]
+        sidecar = self._sidecars.get(key)
+        if sidecar is None:
+            try:
+                sidecar = open_sidecar(filename, self._sidecar_dir)
+            except (OSError, QuillImporterError) as e:
+                # Remembered, so that the notebook is not parsed again for nothing
+                debug('no page sidecar for %s: %s', filename, e)
+                sidecar = False
+            self._sidecars.put(key, sidecar)
+        return sidecar or None
+
+    def get_page(self, filename, n):
+        """
+        Return the n-th page of the notebook, parsing it only if it is
+        not cached yet.
+        """
+        key = self._key(filename, n)
+        page = self._pages.get(key)
+        if page is None:
+            sidecar = self._sidecar(key, filename)
+            if sidecar is not None:
+                page = sidecar.get_page(n)
+            else:
+                with QuillImporter(filename) as importer:
+                    page = importer.get_page(n)
+            # Display lists, the spatial index and image data come later
+            page.on_growth(functools.partial(self._pages.resize, key))
+            self._pages.put(key, page)
+        return page
+
+    def page_digest(self, filename, n):
+        """
+        Return the content digest of the n-th page of the notebook
+        without parsing it: from the cached page if there is one, else
+        by hashing the page record.
+        """
+        key = self._key(filename, n)
+        page = self._pages.get(key)
+        if page is not None:
+            return page.digest
+        digest = self._digests.get(key)
+        if digest is None:
+            sidecar = self._sidecar(key, filename)
+            if sidecar is not None:
+                digest = sidecar.page_digest(n)
+            else:
+                with QuillImporter(filename) as importer:
+                    digest = importer.page_digest(n)
+            self._digests.put(key, digest)
+        return digest
+
+    def page_digests(self, filename, open_importer=None):
+        """
+        Return the content digests of all the pages of the notebook,
+        reading them at most once while it is unchanged. On a miss they
+        are read through the importer returned by open_importer(), which
+        the caller closes, if it is given.
+        """
+        key = self._key(filename, None)
+        digests = self._digests.get(key)
+        if digests is None:
+            sidecar = self._sidecar(key, filename)
+            if sidecar is not None:
+                digests = tuple(sidecar.page_digest(n) for n in range(sidecar.n_pages()))
+            elif open_importer is not None:
+                importer = open_importer()
+                digests = tuple(importer.page_digest(n) for n in range(importer.n_pages()))
+            else:
+                with QuillImporter(filename) as importer:
+                    digests = tuple(importer.page_digest(n) for n in range(importer.n_pages()))
+            for n, digest in enumerate(digests):
+                self._digests.put(key[:-1] + (n,), digest)
+            self._digests.put(key, digests)
+        return digests
+
+    def clear(self):
+        self._pages.clear()
+        self._digests.clear()
+        if self._sidecars is not None:
+            self._sidecars.clear()
+
+    def stats(self):
+        return self._pages.stats()
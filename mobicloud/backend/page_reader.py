@@ -0,0 +1,88 @@
+"""
+Cursor over the bytes of a Quill record (page or index)
+
+The whole member is held in one buffer and walked with a memoryview,
+so fields are decoded straight out of it with precompiled struct
+layouts instead of a read() and a format-string parse per field.
+"""
+
+import struct
+
+from backend.base import QuillImporterError
+
+INT = struct.Struct('>i')
+SHORT = struct.Struct('>h')
+LONG = struct.Struct('>q')
+FLOAT = struct.Struct('>f')
+BOOL = struct.Struct('>?')
+
+# version, npages
+INDEX_HEADER = struct.Struct('>ii')
+# pen colour, thickness, tool
+TOOL_INFO = struct.Struct('>Iii')
+# the four coordinates of a line, rectangle, oval, triangle or table
+SHAPE_BODY = struct.Struct('>ffff')
+# left, right, top, bottom, constrain aspect
+IMAGE_BODY = struct.Struct('>ffff?')
+# version, tool, left, right, top, bottom
+TEXTBOX_HEADER = struct.Struct('>iiffff')
+# font size, colour, bold, italic, underline
+TEXTBOX_STYLE = struct.Struct('>iI???')
+# table rows, table columns
+TABLE_SIZE = struct.Struct('>ii')
+
+
+class PageReader(object):
+    """
+    Read fields sequentially from an in-memory Quill record
+    """
+    def __init__(self, data, pos=0):
+        self._view = memoryview(data)
+        self._pos = pos
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos):
+        self._pos = pos
+
+    def at(self, pos):
+        """
+        Return a new reader over the same buffer, positioned at pos
+        """
+        return PageReader(self._view, pos)
+
+    def unpack(self, layout):
+        """
+        Decode one record with the given struct.Struct layout
+        """
+        try:
+            value = layout.unpack_from(self._view, self._pos)
+        except struct.error:
+            raise QuillImporterError('unexpected end of Quill record')
+        self._pos += layout.size
+        return value
+
+    def view(self, n):
+        """
+        Return the next n bytes as a memoryview into the buffer
+        """
+        end = self._pos + n
+        if n < 0 or end > len(self._view):
+            raise QuillImporterError('unexpected end of Quill record')
+        v = self._view[self._pos:end]
+        self._pos = end
+        return v
+
+    def skip(self, n):
+        self.view(n)
+
+    def read(self, n):
+        return self.view(n).tobytes()
+
+    def string(self):
+        """
+        Read a string prefixed with its length as a signed short
+        """
+        nbytes = self.unpack(SHORT)
+        return str(self.view(nbytes[0]), 'utf-8')
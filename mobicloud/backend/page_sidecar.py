@@ -0,0 +1,301 @@
+"""
+Binary sidecar files of parsed Quill pages
+
+A sidecar holds every page of a notebook already decoded, in a fixed
+layout that is used in place through a memory map: the typed arrays of
+each primitive section (see primitive_arrays) are stored as they are in
+memory, and loading a page only reads its header and the textbox and
+image records. Nothing is parsed from the archive again.
+
+The sidecar is keyed by the SHA-1 of the archive content, stored in its
+header. It lives next to the archive (``demo.note.pages``) or, given a
+cache directory, in a file named after that digest. A sidecar written by
+another format version, on a machine of other byte order, or for other
+archive content is rebuilt by open_sidecar().
+
+Layout, all integers little-endian and every array 8-byte aligned:
+
+    header                      HEADER
+    page table                  PAGE_ENTRY per page
+    per page:
+        page header             PAGE_HEADER
+        per array section       SECTION_HEADER, item counts of its fields,
+                                palette (red, green, blue bytes), fields
+        textboxes               count, TEXTBOX_RECORD each, text blob
+        images                  count, IMAGE_RECORD each
+"""
+
+import functools
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from backend.base import QuillImporterError
+from backend.image import Image
+from backend.instrumentation import staged, debug
+from backend.lru_cache import SizedLRUCache
+from backend.page_reader import PageReader
+from backend.quill_import import QuillArchive, QuillBlob, QuillImporter, QuillPage
+from backend.quill_export import create_replacement
+from backend.textbox import TextBox
+
+MAGIC = b'QNPAGES\0'
+FORMAT_VERSION = 1
+
+SUFFIX = '.pages'
+
+# magic, format version, big-endian flag, archive SHA-1, number of pages
+HEADER = struct.Struct('<8sHH20sI4x')
+# offset, size, page digest (hex)
+PAGE_ENTRY = struct.Struct('<QQ40s')
+# page version, aspect ratio, has uuid, uuid
+PAGE_HEADER = struct.Struct('<id?36s3x')
+# number of palette colours
+SECTION_HEADER = struct.Struct('<I4x')
+COUNT = struct.Struct('<I4x')
+# left, right, top, bottom, red, green, blue, font size, bold, italic, underline, text bytes
+TEXTBOX_RECORD = struct.Struct('<ffffBBBi???I')
+# uuid, x0, x1, y0, y1, constrain aspect
+IMAGE_RECORD = struct.Struct('<36sffff?')
+
+# The sections stored as typed arrays, in file order
+ARRAY_SECTIONS = tuple(QuillPage.section_types)
+
+ALIGNMENT = 8
+
+HASH_CHUNK = 1 << 20
+
+
+class SidecarError(QuillImporterError):
+    pass
+
+
+def _padding(pos):
+    return -pos % ALIGNMENT
+
+
+_archive_digests = SizedLRUCache(1024, sizeof=lambda digest: 1)
+
+
+def archive_digest(filename):
+    """
+    Return the SHA-1 hex digest of the archive content. It is only
+    computed again when the size or mtime of the file changes.
+    """
+    st = os.stat(filename)
+    key = (os.path.realpath(filename), st.st_mtime_ns, st.st_size)
+    digest = _archive_digests.get(key)
+    if digest is None:
+        h = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iter(functools.partial(f.read, HASH_CHUNK), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        _archive_digests.put(key, digest)
+    return digest
+
+
+def sidecar_path(filename, digest, cache_dir=None):
+    if cache_dir is None:
+        return filename + SUFFIX
+    return os.path.join(cache_dir, digest + SUFFIX)
+
+
+def _read_blob(filename, uuid):
+    archive = QuillArchive(filename)
+    try:
+        return QuillBlob(archive).get(uuid)
+    finally:
+        archive.close()
+
+
+class SidecarWriter(object):
+    """
+    Write the pages of a notebook to a sidecar file
+    """
+    def __init__(self, out):
+        self._out = out
+
+    def _write(self, data):
+        self._out.write(data)
+
+    def _align(self):
+        self._write(b'\0' * _padding(self._out.tell()))
+
+    def write_array_section(self, primitives):
+        palette = primitives.palette()
+        buffers = primitives.buffers()
+        self._write(SECTION_HEADER.pack(len(palette)))
+        for buf in buffers:
+            self._write(COUNT.pack(len(buf)))
+        self._write(bytes(c for rgb in palette for c in rgb))
+        for buf in buffers:
+            self._align()
+            self._write(buf.tobytes())
+        self._align()
+
+    def write_textboxes(self, textboxes):
+        texts = [textbox.textStr().encode('utf-8') for textbox in textboxes]
+        self._write(COUNT.pack(len(textboxes)))
+        for textbox, text in zip(textboxes, texts):
+            red, green, blue = textbox.rgb()[:3]
+            self._write(TEXTBOX_RECORD.pack(textbox.left(), textbox.right(), textbox.top(), textbox.bottom(),
+                                            red, green, blue, textbox.textSize(), bool(textbox.isBold()),
+                                            bool(textbox.isItalic()), bool(textbox.isUnderline()), len(text)))
+        self._write(b''.join(texts))
+        self._align()
+
+    def write_images(self, images):
+        self._write(COUNT.pack(len(images)))
+        for image in images:
+            self._write(IMAGE_RECORD.pack(image.uuid().encode('utf-8'), image.x0(), image.x1(),
+                                          image.y0(), image.y1(), bool(image.constrain_aspect())))
+        self._align()
+
+    def write_page(self, page):
+        uuid = getattr(page, 'uuid', None)
+        self._write(PAGE_HEADER.pack(page.version[0], page.aspect_ratio, uuid is not None, bytes(uuid or b'')))
+        for name in ARRAY_SECTIONS:
+            self.write_array_section(getattr(page, name))
+        self.write_textboxes(page.textboxes)
+        self.write_images(page.images)
+
+    def write(self, importer, digest):
+        n_pages = importer.n_pages()
+        self._write(HEADER.pack(MAGIC, FORMAT_VERSION, sys.byteorder == 'big', bytes.fromhex(digest), n_pages))
+        table_pos = self._out.tell()
+        self._write(b'\0' * (PAGE_ENTRY.size * n_pages))
+        entries = []
+        for n in range(n_pages):
+            # Lazy, so that image data is not read from the archive
+            page = importer.get_page(n, lazy=True)
+            start = self._out.tell()
+            self.write_page(page)
+            entries.append(PAGE_ENTRY.pack(start, self._out.tell() - start, page.digest.encode('ascii')))
+        self._out.seek(table_pos)
+        self._write(b''.join(entries))
+
+
+@staged('sidecar_build')
+def build_sidecar(filename, path, digest=None):
+    """
+    Parse the notebook and write its sidecar to path, replacing any
+    previous one atomically
+    """
+    if digest is None:
+        digest = archive_digest(filename)
+    fd, tmp = create_replacement(path)
+    try:
+        with os.fdopen(fd, 'wb') as out, QuillImporter(filename) as importer:
+            SidecarWriter(out).write(importer, digest)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class PageSidecar(object):
+    """
+    Memory-mapped sidecar of a notebook
+
+    Pages are served from the map without copying their arrays, so the
+    map stays open as long as any page made from it is alive.
+    """
+    def __init__(self, path, archive_filename):
+        self._path = path
+        self._archive_filename = archive_filename
+        with open(path, 'rb') as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise SidecarError('empty page sidecar ' + path)
+        self._view = memoryview(self._map)
+        fp = PageReader(self._view)
+        magic, version, big_endian, digest, n_pages = fp.unpack(HEADER)
+        if magic != MAGIC:
+            raise SidecarError('not a page sidecar: ' + path)
+        if version != FORMAT_VERSION or big_endian != (sys.byteorder == 'big'):
+            raise SidecarError('page sidecar of another format: ' + path)
+        self.archive_digest = digest.hex()
+        self._entries = [fp.unpack(PAGE_ENTRY) for n in range(n_pages)]
+
+    def n_pages(self):
+        return len(self._entries)
+
+    def page_digest(self, n):
+        return self._entries[n][2].decode('ascii')
+
+    def _read_array_section(self, fp, name):
+        cls = QuillPage.section_types[name]
+        n_colors, = fp.unpack(SECTION_HEADER)
+        counts = [fp.unpack(COUNT)[0] for field in cls.fields]
+        palette = fp.read(3 * n_colors)
+        palette = [tuple(palette[i:i+3]) for i in range(0, len(palette), 3)]
+        empty = cls()
+        buffers = []
+        for field, count in zip(cls.fields, counts):
+            fp.skip(_padding(fp.tell()))
+            typecode = getattr(empty, field).typecode
+            buffers.append(fp.view(count * array(typecode).itemsize).cast(typecode))
+        fp.skip(_padding(fp.tell()))
+        return cls.from_buffers(palette, buffers)
+
+    def _read_textboxes(self, fp):
+        n, = fp.unpack(COUNT)
+        records = [fp.unpack(TEXTBOX_RECORD) for i in range(n)]
+        textboxes = []
+        for left, right, top, bottom, red, green, blue, size, bold, italic, underline, length in records:
+            text = bytes(fp.view(length)).decode('utf-8')
+            textboxes.append(TextBox(red, green, blue, left, right, top, bottom, text, size, bold, italic, underline))
+        fp.skip(_padding(fp.tell()))
+        return textboxes
+
+    def _read_images(self, fp):
+        n, = fp.unpack(COUNT)
+        images = []
+        for i in range(n):
+            uuid, x0, x1, y0, y1, constrain = fp.unpack(IMAGE_RECORD)
+            images.append(Image(uuid, x0, x1, y0, y1, constrain, None,
+                                data_loader=functools.partial(_read_blob, self._archive_filename, uuid)))
+        fp.skip(_padding(fp.tell()))
+        return images
+
+    @staged('sidecar_load')
+    def get_page(self, n):
+        """
+        Return the n-th page. Image data is read from the archive when
+        it is first asked for.
+        """
+        offset, size, digest = self._entries[n]
+        fp = PageReader(self._view[offset:offset + size])
+        version, aspect_ratio, has_uuid, uuid = fp.unpack(PAGE_HEADER)
+        sections = {}
+        for name in ARRAY_SECTIONS:
+            sections[name] = self._read_array_section(fp, name)
+        sections['textboxes'] = self._read_textboxes(fp)
+        sections['images'] = self._read_images(fp)
+        return QuillPage.from_sections(sections, aspect_ratio, (version,), uuid if has_uuid else None,
+                                       digest.decode('ascii'))
+
+
+def open_sidecar(filename, cache_dir=None):
+    """
+    Return the PageSidecar of the notebook, building it first if it is
+    missing or stale. Raises OSError if it cannot be written.
+    """
+    digest = archive_digest(filename)
+    path = sidecar_path(filename, digest, cache_dir)
+    try:
+        sidecar = PageSidecar(path, filename)
+        if sidecar.archive_digest == digest:
+            return sidecar
+        debug('page sidecar %s is stale', path)
+    except FileNotFoundError:
+        pass
+    except QuillImporterError as e:
+        debug('rebuilding page sidecar: %s', e)
+    build_sidecar(filename, path, digest)
+    return PageSidecar(path, filename)
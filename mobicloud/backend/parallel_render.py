@@ -0,0 +1,75 @@
+"""
+Render the pages of a notebook on a pool of processes
+
+Drawing a page is CPU-bound Python, so one process only keeps one core
+busy. Page numbers are handed out to worker processes; each worker
+opens the archive once, when it starts, and sends back the encoded
+PNG of every page it is given. Results come back in page order.
+"""
+
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from backend.cairo_context import CairoContext
+from backend.quill_import import QuillImporter
+
+# Size of the rendered pages, in pixels
+WIDTH = 410
+HEIGHT = 547
+
+# The notebook opened by this worker process
+_importer = None
+
+
+def _init_worker(filename):
+    global _importer
+    _importer = QuillImporter(filename)
+
+
+def _render(importer, n, width, height):
+    buff = io.BytesIO()
+    ctr = CairoContext(buff, width, height, importer.get_page(n))
+    ctr.draw_page()
+    return ctr.write_to_buff(buff).getvalue()
+
+
+def _render_page(job):
+    n, width, height = job
+    return _render(_importer, n, width, height)
+
+
+def iter_render_notebook(filename, pages=None, width=WIDTH, height=HEIGHT, workers=None, chunksize=None):
+    """
+    Yield the PNG bytes of the given pages (all of them by default), in
+    order, rendering them on a pool of workers processes (one per CPU
+    by default). Jobs are sent to the workers chunksize pages at a
+    time; by default about four chunks go to each worker.
+    """
+    if pages is None:
+        with QuillImporter(filename) as importer:
+            pages = range(importer.n_pages())
+    pages = list(pages)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(pages)))
+    if workers == 1:
+        # Not worth starting a pool
+        with QuillImporter(filename) as importer:
+            for n in pages:
+                yield _render(importer, n, width, height)
+        return
+    if chunksize is None:
+        chunksize = max(1, len(pages) // (workers * 4))
+    jobs = [(n, width, height) for n in pages]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(filename,)) as pool:
+        for png in pool.map(_render_page, jobs, chunksize=chunksize):
+            yield png
+
+
+def render_notebook(filename, pages=None, width=WIDTH, height=HEIGHT, workers=None, chunksize=None):
+    """
+    Return the list of PNG bytes of the given pages, see
+    iter_render_notebook()
+    """
+    return list(iter_render_notebook(filename, pages, width, height, workers, chunksize))
@@ -0,0 +1,75 @@
+"""
+Vector PDF export of a whole notebook
+
+Pages are parsed, drawn onto a cairo.PDFSurface and emitted one at a
+time, and the PDF bytes are handed out as soon as cairo writes them, so
+peak memory stays around one page whatever the length of the notebook.
+"""
+
+import cairo
+
+from backend.cairo_context import CairoContext
+from backend.quill_import import QuillImporter
+
+# Page size in PDF points (A4)
+PDF_WIDTH = 595
+PDF_HEIGHT = 842
+
+
+class _ChunkWriter(object):
+    """
+    File-like sink collecting what cairo writes until it is taken
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_pdf(importer, width=PDF_WIDTH, height=PDF_HEIGHT):
+    """
+    Generate the PDF of the notebook opened by importer as a sequence
+    of byte strings, one or more per page
+    """
+    out = _ChunkWriter()
+    surface = cairo.PDFSurface(out, width, height)
+    for page in importer.iter_pages():
+        w, h = width, height
+        if page.aspect_ratio > 1:
+            w, h = h, w
+        surface.set_size(w, h)
+        # Vector output: no simplification, zooming in must stay exact
+        ctr = CairoContext(None, w, h, page, lod=False, surface=surface)
+        ctr.draw_page()
+        surface.show_page()
+        chunk = out.take()
+        if chunk:
+            yield chunk
+    surface.finish()
+    yield out.take()
+
+
+def stream_pdf_file(filename, width=PDF_WIDTH, height=PDF_HEIGHT):
+    """
+    Like stream_pdf(), opening the notebook file itself and closing it
+    once the PDF is complete
+    """
+    with QuillImporter(filename) as importer:
+        for chunk in stream_pdf(importer, width, height):
+            yield chunk
+
+
+def write_pdf(filename, dest, width=PDF_WIDTH, height=PDF_HEIGHT):
+    """
+    Write the PDF of the notebook file to the file object dest
+    """
+    for chunk in stream_pdf_file(filename, width, height):
+        dest.write(chunk)
+    return dest
@@ -0,0 +1,394 @@
+"""
+Compact storage of the primitives of a parsed page
+
+Each primitive kind of a QuillPage is kept as one array object: parallel
+typed arrays of coordinates, colours and pen thickness, instead of one
+Python object with an instance dict per primitive. Colours are stored
+as indices into a palette of shared (red, green, blue) tuples, so rgb()
+allocates nothing.
+
+Indexing or iterating an array returns small __slots__ views (LineView,
+RectangleView, ...) that have the accessors of the model classes (Line,
+Rectangle, ...). Views are created on demand and thrown away, so nothing
+may be cached on them: anything derived from a primitive (such as the
+simplified points of a stroke) is cached in its array, keyed by position.
+
+Arrays are filled while the page is parsed and must not grow once views
+of them are in use. from_buffers() makes read-only arrays over existing
+buffers instead, such as memoryviews of a mapped page sidecar file.
+"""
+
+import abc
+from array import array
+
+from backend.line import Line
+from backend.rectangle import Rectangle
+from backend.oval import Oval
+from backend.triangle import Triangle
+from backend.table import Table
+from backend.stroke import Stroke, points_from_bytes
+from backend.simplify import simplify_points
+
+
+def _nbytes(a):
+    return a.itemsize * len(a)
+
+
+class PrimitiveArray(object):
+    """
+    Colour and thickness of a list of primitives, and the view protocol
+    """
+    view_class = None
+
+    # The typed arrays holding the primitives, see from_buffers()
+    fields = ('_colors', '_thickness')
+
+    def __init__(self):
+        self._colors = array('H')
+        self._thickness = array('i')
+        self._palette = []
+        self._palette_index = {}
+
+    def _add_style(self, thickness, red, green, blue):
+        rgb = (red, green, blue)
+        index = self._palette_index.get(rgb)
+        if index is None:
+            index = self._palette_index[rgb] = len(self._palette)
+            self._palette.append(rgb)
+        self._colors.append(index)
+        self._thickness.append(thickness)
+
+    @classmethod
+    def from_buffers(cls, palette, buffers):
+        """
+        Return a read-only array of primitives over existing buffers,
+        one per entry of fields, with the item types of those fields
+        """
+        primitives = cls()
+        for name, buf in zip(cls.fields, buffers):
+            setattr(primitives, name, buf)
+        primitives._palette = [tuple(rgb) for rgb in palette]
+        primitives._palette_index = None
+        return primitives
+
+    def palette(self):
+        return self._palette
+
+    def buffers(self):
+        return [getattr(self, name) for name in self.fields]
+
+    def __len__(self):
+        return len(self._thickness)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.view_class(self, k) for k in range(*i.indices(len(self)))]
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('primitive index out of range')
+        return self.view_class(self, i)
+
+    def __iter__(self):
+        view_class = self.view_class
+        for i in range(len(self)):
+            yield view_class(self, i)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def nbytes(self):
+        """
+        Return the size of the arrays, in bytes
+        """
+        return _nbytes(self._colors) + _nbytes(self._thickness) + 64 * len(self._palette)
+
+
+class PrimitiveView(metaclass=abc.ABCMeta):
+    __slots__ = ('_array', '_i')
+
+    def __init__(self, primitives, i):
+        self._array = primitives
+        self._i = i
+
+    def rgb(self):
+        return self._array._palette[self._array._colors[self._i]]
+
+    def thickness(self):
+        return self._array._thickness[self._i]
+
+    @abc.abstractmethod
+    def model(self):
+        """
+        Return the primitive as a standalone model object
+        """
+
+    def __repr__(self):
+        return repr(self.model())
+
+
+class ShapeArray(PrimitiveArray):
+    """
+    Primitives described by four coordinates, stored in the order of
+    the model class constructors
+    """
+    fields = PrimitiveArray.fields + ('_coords',)
+
+    def __init__(self):
+        super(ShapeArray, self).__init__()
+        self._coords = array('f')
+
+    def add(self, thickness, red, green, blue, a, b, c, d):
+        self._add_style(thickness, red, green, blue)
+        self._coords.extend((a, b, c, d))
+
+    def nbytes(self):
+        return super(ShapeArray, self).nbytes() + _nbytes(self._coords)
+
+
+class LineView(PrimitiveView):
+    __slots__ = ()
+
+    def x0(self):
+        return self._array._coords[4*self._i]
+
+    def y0(self):
+        return self._array._coords[4*self._i+1]
+
+    def x1(self):
+        return self._array._coords[4*self._i+2]
+
+    def y1(self):
+        return self._array._coords[4*self._i+3]
+
+    def bbox(self):
+        x0, y0, x1, y1 = self._array._coords[4*self._i:4*self._i+4]
+        return (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+
+    def model(self):
+        red, green, blue = self.rgb()
+        return Line(red, green, blue, self.thickness(), self.x0(), self.y0(), self.x1(), self.y1())
+
+
+class BoxView(PrimitiveView):
+    """
+    View of a primitive stored as left, right, top, bottom
+    """
+    __slots__ = ()
+    model_class = None
+
+    def left(self):
+        return self._array._coords[4*self._i]
+
+    def right(self):
+        return self._array._coords[4*self._i+1]
+
+    def top(self):
+        return self._array._coords[4*self._i+2]
+
+    def bottom(self):
+        return self._array._coords[4*self._i+3]
+
+    def bbox(self):
+        left, right, top, bottom = self._array._coords[4*self._i:4*self._i+4]
+        return (min(left, right), min(top, bottom), max(left, right), max(top, bottom))
+
+    def model(self):
+        red, green, blue = self.rgb()
+        return self.model_class(self.thickness(), red, green, blue, self.left(), self.right(), self.top(), self.bottom())
+
+
+class RectangleView(BoxView):
+    __slots__ = ()
+    model_class = Rectangle
+
+    def width(self):
+        return self.right() - self.left()
+
+    def height(self):
+        return self.bottom() - self.top()
+
+
+class OvalView(BoxView):
+    __slots__ = ()
+    model_class = Oval
+
+    def center_coordinate(self):
+        left, right, top, bottom = self._array._coords[4*self._i:4*self._i+4]
+        return ((left + ((right - left) / 2)), (top + ((bottom - top) / 2)))
+
+
+class TriangleView(BoxView):
+    __slots__ = ()
+    model_class = Triangle
+
+    def middle(self):
+        return (self.left() + self.right()) / 2
+
+
+class LineArray(ShapeArray):
+    view_class = LineView
+
+
+class RectangleArray(ShapeArray):
+    view_class = RectangleView
+
+
+class OvalArray(ShapeArray):
+    view_class = OvalView
+
+
+class TriangleArray(ShapeArray):
+    view_class = TriangleView
+
+
+class TableArray(ShapeArray):
+    """
+    Tables, with the row and column line fractions of all the tables
+    in two flat arrays
+    """
+    fields = ShapeArray.fields + ('_rows', '_row_offsets', '_cols', '_col_offsets')
+
+    def __init__(self):
+        super(TableArray, self).__init__()
+        self._rows = array('f')
+        self._row_offsets = array('I', [0])
+        self._cols = array('f')
+        self._col_offsets = array('I', [0])
+
+    def add(self, thickness, red, green, blue, left, right, top, bottom, rows, cols):
+        super(TableArray, self).add(thickness, red, green, blue, left, right, top, bottom)
+        self._rows.extend(rows)
+        self._row_offsets.append(len(self._rows))
+        self._cols.extend(cols)
+        self._col_offsets.append(len(self._cols))
+
+    def nbytes(self):
+        return (super(TableArray, self).nbytes() + _nbytes(self._rows) + _nbytes(self._row_offsets) +
+                _nbytes(self._cols) + _nbytes(self._col_offsets))
+
+
+class TableView(BoxView):
+    __slots__ = ()
+
+    def lineRowPer(self):
+        a = self._array
+        return a._rows[a._row_offsets[self._i]:a._row_offsets[self._i+1]].tolist()
+
+    def lineColPer(self):
+        a = self._array
+        return a._cols[a._col_offsets[self._i]:a._col_offsets[self._i+1]].tolist()
+
+    def table_height(self):
+        return self.bottom() - self.top()
+
+    def table_width(self):
+        return self.right() - self.left()
+
+    def computeRowLine(self):
+        h = self.table_height()
+        return [x * h for x in self.lineRowPer()]
+
+    def computeColLine(self):
+        w = self.table_width()
+        return [x * w for x in self.lineColPer()]
+
+    def model(self):
+        red, green, blue = self.rgb()
+        return Table(self.thickness(), red, green, blue, self.left(), self.right(), self.top(), self.bottom(),
+                     self.lineRowPer(), self.lineColPer())
+
+
+TableArray.view_class = TableView
+
+
+class StrokeArray(PrimitiveArray):
+    """
+    Strokes, with the (x, y, pressure) points of all of them in one flat
+    float array, and their bounding boxes precomputed
+    """
+    fields = PrimitiveArray.fields + ('_pressure', '_points', '_offsets', '_bboxes')
+
+    def __init__(self):
+        super(StrokeArray, self).__init__()
+        self._pressure = array('b')
+        self._points = array('f')
+        self._offsets = array('I', [0])
+        self._bboxes = array('f')
+        # Simplified points, keyed by (stroke position, tolerance bucket)
+        self._lod = {}
+        self._view = None
+
+    def add(self, thickness, red, green, blue, pressure, data):
+        """
+        Append a stroke whose points are given as big-endian float32
+        bytes, as stored in a page record
+        """
+        self._add_style(thickness, red, green, blue)
+        self._pressure.append(1 if pressure else 0)
+        points = points_from_bytes(data)
+        self._points.extend(points)
+        self._offsets.append(len(self._points))
+        if len(points) >= 3:
+            xs = points[0::3]
+            ys = points[1::3]
+            self._bboxes.extend((min(xs), min(ys), max(xs), max(ys)))
+        else:
+            self._bboxes.extend((float('nan'),) * 4)
+
+    def points(self, i):
+        if self._view is None:
+            self._view = memoryview(self._points)
+        return self._view[self._offsets[i]:self._offsets[i+1]]
+
+    def simplified(self, i, bucket):
+        key = (i, bucket)
+        points = self._lod.get(key)
+        if points is None:
+            points = self._lod[key] = simplify_points(self.points(i), 2.0**bucket, bool(self._pressure[i]))
+        return points
+
+    def nbytes(self):
+        size = (super(StrokeArray, self).nbytes() + _nbytes(self._pressure) + _nbytes(self._points) +
+                _nbytes(self._offsets) + _nbytes(self._bboxes))
+        for points in self._lod.values():
+            if isinstance(points, array):
+                size += _nbytes(points)
+        return size
+
+
+class StrokeView(PrimitiveView):
+    __slots__ = ()
+
+    def points(self):
+        return self._array.points(self._i)
+
+    def n_points(self):
+        a = self._array
+        return (a._offsets[self._i+1] - a._offsets[self._i]) // 3
+
+    def get_point(self, i):
+        if i < 0:
+            i += self.n_points()
+        p = self._array._points
+        k = self._array._offsets[self._i] + 3*i
+        return (p[k], p[k+1], p[k+2])
+
+    def simplified(self, bucket):
+        return self._array.simplified(self._i, bucket)
+
+    def bbox(self):
+        if self._array._offsets[self._i+1] - self._array._offsets[self._i] < 3:
+            return None
+        return tuple(self._array._bboxes[4*self._i:4*self._i+4])
+
+    def has_pressure(self):
+        return bool(self._array._pressure[self._i])
+
+    def model(self):
+        red, green, blue = self.rgb()
+        return Stroke(self.thickness(), red, green, blue, self.has_pressure(), array('f', self.points()))
+
+
+StrokeArray.view_class = StrokeView
@@ -0,0 +1,322 @@
+"""
+Writer for Quill .note archives
+
+The counterpart of quill_import: pages built from the backend model
+classes (Stroke, Line, Rectangle, Oval, Triangle, Table, TextBox and
+Image) are written as version 13 page records, the notebook index as a
+version 7 index, and image data as jpg members, in the layout that
+QuillImporter reads back.
+
+EXAMPLES::
+
+    >>> with QuillExporter('out.note', title='Example') as exporter:
+    ...     page = PageContent()
+    ...     page.lines.append(Line(0, 0, 255, 5, 0.1, 0.1, 0.6, 0.1))
+    ...     exporter.add_page(page)
+"""
+
+import io
+import os
+import stat
+import struct
+import sys
+import tarfile
+import time
+import uuid as uuid_module
+from array import array
+
+from backend.page_reader import INT, SHORT, LONG, FLOAT, BOOL, INDEX_HEADER, TOOL_INFO, SHAPE_BODY, IMAGE_BODY, TEXTBOX_HEADER, TEXTBOX_STYLE, TABLE_SIZE
+
+PAGE_VERSION = 13
+INDEX_VERSION = 7
+
+# Height over width of an A4 page in portrait, the usual Quill paper
+DEFAULT_ASPECT_RATIO = 1 / 1.4142
+
+# Tool numbers stored with each primitive, as checked by the reader
+TOOL_FOUNTAIN_PEN = 0
+TOOL_PENCIL = 1
+TOOL_TEXTBOX = 4
+TOOL_LINE = 5
+TOOL_RECTANGLE = 10
+TOOL_OVAL = 11
+TOOL_TRIANGLE = 12
+TOOL_TABLE = 15
+
+STROKE_VERSION = 3
+
+
+def _uuid():
+    return str(uuid_module.uuid4())
+
+
+def _argb(item):
+    red, green, blue = item.rgb()[:3]
+    return 0xFF000000 | (int(red) & 0xFF) << 16 | (int(green) & 0xFF) << 8 | (int(blue) & 0xFF)
+
+
+def _string(s):
+    data = s.encode('utf-8')
+    if len(data) > 0x7FFF:
+        raise ValueError('string too long for a Quill record')
+    return SHORT.pack(len(data)) + data
+
+
+def _uuid_field(u):
+    data = u.encode('utf-8') if isinstance(u, str) else bytes(u)
+    if len(data) != 36:
+        raise ValueError('uuid must be 36 characters long: ' + repr(u))
+    return SHORT.pack(36) + data
+
+
+def create_replacement(path):
+    """
+    Create an empty temporary file next to path, to be renamed over it
+    once complete. Return its file descriptor and name.
+
+    The file gets the mode that writing path in place would give it:
+    the mode of path if it exists, else 0666 less the umask.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    tmp = os.path.join(directory, '.%s.%s.tmp' % (name, uuid_module.uuid4().hex))
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        os.fchmod(fd, stat.S_IMODE(os.stat(path).st_mode))
+    except FileNotFoundError:
+        pass
+    return fd, tmp
+
+
+def _empty_tag_set():
+    # version, no tags, and the two words the reader skips
+    return INT.pack(1) + INT.pack(0) + INT.pack(0) + INT.pack(0)
+
+
+def _points_to_bytes(points):
+    """
+    Encode a flat (x, y, pressure) array as big-endian float32 triples
+    """
+    points = array('f', points)
+    if sys.byteorder == 'little':
+        points.byteswap()
+    return points.tobytes()
+
+
+class PageContent(object):
+    """
+    The primitives of a page to write, in the sections QuillPage reads
+    """
+    def __init__(self, aspect_ratio=DEFAULT_ASPECT_RATIO):
+        self.aspect_ratio = aspect_ratio
+        self.strokes = []
+        self.lines = []
+        self.rectangles = []
+        self.ovals = []
+        self.triangles = []
+        self.tables = []
+        self.textboxes = []
+        self.images = []
+
+
+class QuillPageWriter(object):
+    """
+    Encode a page as a Quill page record
+
+    page can be a PageContent or a QuillPage read from another notebook.
+    timestamp is the modification time recorded in the page, in
+    milliseconds.
+    """
+    def __init__(self, page, uuid=None, timestamp=None):
+        self._page = page
+        self.uuid = uuid if uuid is not None else _uuid()
+        self.timestamp = timestamp if timestamp is not None else int(time.time() * 1000)
+
+    def _section(self, name, writer):
+        items = getattr(self._page, name, ())
+        return INT.pack(len(items)) + b''.join(writer(item) for item in items)
+
+    def write_textbox(self, textbox):
+        return (TEXTBOX_HEADER.pack(1, TOOL_TEXTBOX, textbox.left(), textbox.right(), textbox.top(), textbox.bottom()) +
+                _string(textbox.textStr()) +
+                TEXTBOX_STYLE.pack(int(textbox.textSize()), _argb(textbox), bool(textbox.isBold()),
+                                   bool(textbox.isItalic()), bool(textbox.isUnderline())))
+
+    def write_image(self, image):
+        return (INT.pack(1) + _uuid_field(image.uuid()) +
+                IMAGE_BODY.pack(image.x0(), image.x1(), image.y0(), image.y1(), bool(image.constrain_aspect())))
+
+    def _tool_info(self, item, tool):
+        return TOOL_INFO.pack(_argb(item), int(round(item.thickness())), tool)
+
+    def write_line(self, line):
+        return (INT.pack(1) + self._tool_info(line, TOOL_LINE) +
+                SHAPE_BODY.pack(line.x0(), line.y0(), line.x1(), line.y1()))
+
+    def write_rectangle(self, rectangle):
+        return (INT.pack(1) + self._tool_info(rectangle, TOOL_RECTANGLE) +
+                SHAPE_BODY.pack(rectangle.left(), rectangle.right(), rectangle.top(), rectangle.bottom()))
+
+    def write_oval(self, oval):
+        # Ovals store their right edge before their left one
+        return (INT.pack(1) + self._tool_info(oval, TOOL_OVAL) +
+                SHAPE_BODY.pack(oval.right(), oval.left(), oval.top(), oval.bottom()))
+
+    def write_triangle(self, triangle):
+        return (INT.pack(1) + self._tool_info(triangle, TOOL_TRIANGLE) +
+                SHAPE_BODY.pack(triangle.left(), triangle.right(), triangle.top(), triangle.bottom()))
+
+    def write_table(self, table):
+        rows = table.lineRowPer()
+        cols = table.lineColPer()
+        return (INT.pack(1) + self._tool_info(table, TOOL_TABLE) +
+                SHAPE_BODY.pack(table.left(), table.right(), table.top(), table.bottom()) +
+                TABLE_SIZE.pack(len(rows), len(cols)) +
+                struct.pack('>%df' % len(rows), *rows) +
+                struct.pack('>%df' % len(cols), *cols))
+
+    def write_stroke(self, stroke):
+        tool = TOOL_FOUNTAIN_PEN if stroke.has_pressure() else TOOL_PENCIL
+        points = stroke.points()
+        return (INT.pack(STROKE_VERSION) + self._tool_info(stroke, tool) +
+                INT.pack(len(points) // 3) + _points_to_bytes(points))
+
+    def record(self):
+        """
+        Return the page record as bytes
+        """
+        page = self._page
+        out = io.BytesIO()
+        out.write(INT.pack(PAGE_VERSION))
+        out.write(_uuid_field(self.uuid))
+        out.write(_empty_tag_set())
+        out.write(INT.pack(0))              # paper type
+        out.write(INT.pack(0))
+        out.write(BOOL.pack(False))         # read only
+        out.write(FLOAT.pack(page.aspect_ratio))
+        out.write(INT.pack(0))
+        out.write(_string(''))              # paper path
+        out.write(INT.pack(0))
+        out.write(_string(''))              # main tag
+        out.write(INT.pack(0))
+        out.write(_string(str(self.timestamp)))
+        out.write(self._section('textboxes', self.write_textbox))
+        out.write(self._section('images', self.write_image))
+        out.write(self._section('lines', self.write_line))
+        out.write(self._section('rectangles', self.write_rectangle))
+        out.write(self._section('ovals', self.write_oval))
+        out.write(self._section('triangles', self.write_triangle))
+        out.write(self._section('tables', self.write_table))
+        out.write(self._section('strokes', self.write_stroke))
+        return out.getvalue()
+
+
+class QuillExporter(object):
+    """
+    Write a Quill notebook archive page by page
+
+    Pages and image blobs are added to the archive as they come, and the
+    index is written when the exporter is closed. The archive is written
+    to a temporary file that then replaces filename, so readers that
+    memory-map the previous archive are not affected. Leaving a with
+    block through an exception aborts the export and keeps filename.
+    """
+    def __init__(self, filename, title='Untitled Document', uuid=None, ctime=None, mtime=None):
+        self._filename = filename
+        self.title = title
+        self.uuid = uuid if uuid is not None else _uuid()
+        now = int(time.time() * 1000)
+        self.ctime = ctime if ctime is not None else now
+        self.mtime = mtime if mtime is not None else now
+        self._page_uuids = []
+        self._blobs = set()
+        fd, self._tmp_filename = create_replacement(filename)
+        os.close(fd)
+        self._tar = tarfile.open(self._tmp_filename, 'w')
+
+    def _dir(self):
+        return 'notebook_' + self.uuid + '/'
+
+    def _add_member(self, name, data):
+        info = tarfile.TarInfo(self._dir() + name)
+        info.size = len(data)
+        info.mtime = self.mtime // 1000
+        self._tar.addfile(info, io.BytesIO(data))
+
+    def add_page(self, page, uuid=None):
+        """
+        Append a page (a PageContent or a QuillPage) to the notebook, with
+        the image data it refers to. Return the page uuid.
+        """
+        writer = QuillPageWriter(page, uuid, self.mtime)
+        for image in getattr(page, 'images', ()):
+            if image.uuid() not in self._blobs:
+                self._add_member(image.uuid() + '.jpg', image.data())
+                self._blobs.add(image.uuid())
+        self._add_member('page_' + writer.uuid + '.page', writer.record())
+        self._page_uuids.append(writer.uuid)
+        return writer.uuid
+
+    def index_record(self):
+        """
+        Return the notebook index as bytes
+        """
+        out = io.BytesIO()
+        out.write(INDEX_HEADER.pack(INDEX_VERSION, len(self._page_uuids)))
+        for page_uuid in self._page_uuids:
+            out.write(_uuid_field(page_uuid))
+        out.write(INT.pack(0))              # current page
+        out.write(_string(self.title))
+        out.write(LONG.pack(self.ctime))
+        out.write(LONG.pack(self.mtime))
+        out.write(_uuid_field(self.uuid))
+        # Trailer Quill writes after the notebook uuid, which the reader skips
+        out.write(_empty_tag_set())
+        out.write(BOOL.pack(False))
+        out.write(_string(''))
+        out.write(_string(self._page_uuids[0] if self._page_uuids else ''))
+        return out.getvalue()
+
+    def close(self):
+        if self._tar is None:
+            return
+        try:
+            try:
+                self._add_member('index', self.index_record())
+            finally:
+                self._tar.close()
+                self._tar = None
+            os.replace(self._tmp_filename, self._filename)
+        except BaseException:
+            os.unlink(self._tmp_filename)
+            raise
+
+    def abort(self):
+        """
+        Drop the archive written so far, leaving filename untouched
+        """
+        if self._tar is None:
+            return
+        try:
+            self._tar.close()
+        finally:
+            self._tar = None
+            os.unlink(self._tmp_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+def export_notebook(filename, pages, title='Untitled Document', uuid=None):
+    """
+    Write the pages to a new notebook archive. Return its uuid.
+    """
+    with QuillExporter(filename, title, uuid) as exporter:
+        for page in pages:
+            exporter.add_page(page)
+    return exporter.uuid
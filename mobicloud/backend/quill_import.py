@@ -1,46 +1,209 @@
 import tarfile
 import struct
 import os
-import cairo
+import mmap
+import weakref
+import threading
+import functools
+import hashlib
+import math
+from collections import OrderedDict
 
 from backend.base import ImporterBase, QuillImporterError
-from backend.triangle import Triangle
-from backend.line import Line
 from backend.textbox import TextBox
-from backend.rectangle import Rectangle
-from backend.oval import Oval
-from backend.table import Table
-from backend.stroke import Stroke
 from backend.image import Image
+from backend.primitive_arrays import LineArray, RectangleArray, OvalArray, TriangleArray, TableArray, StrokeArray
+from backend.spatial_index import GridIndex
+from backend.instrumentation import stage, staged, count as count_work, debug
+from backend.page_reader import PageReader, INT, SHORT, LONG, FLOAT, BOOL, INDEX_HEADER, TOOL_INFO, SHAPE_BODY, IMAGE_BODY, TEXTBOX_HEADER, TEXTBOX_STYLE, TABLE_SIZE
 
 current_path = os.path.dirname(os.path.realpath(__file__))
 
+UUID_LENGTH = 36
+
+def _distance_to_polyline(points, x, y):
+    """
+    Distance from (x, y) to the polyline through the (x, y, pressure)
+    triples of points
+    """
+    best = math.hypot(points[0] - x, points[1] - y)
+    for i in range(3, len(points), 3):
+        ax, ay = points[i-3], points[i-2]
+        dx, dy = points[i] - ax, points[i+1] - ay
+        length = dx*dx + dy*dy
+        t = 0.0
+        if length > 0:
+            t = max(0.0, min(1.0, ((x - ax)*dx + (y - ay)*dy) / length))
+        best = min(best, math.hypot(ax + t*dx - x, ay + t*dy - y))
+    return best
+
+
+# Most archives memory-mapped at once. A map holds a file descriptor for
+# as long as any member slice of it is alive, e.g. the image data of a
+# cached page; archives opened beyond this are read through tarfile.
+MAX_MAPPED_ARCHIVES = 64
+
+# Live maps, keyed by the identity and version of the file they map
+_maps = weakref.WeakValueDictionary()
+_maps_lock = threading.Lock()
+
+def _map_archive(f):
+    """
+    Return a read-only map of the open file, shared with the archives
+    already mapping the same file, or None if too many maps are alive
+    """
+    st = os.fstat(f.fileno())
+    key = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+    with _maps_lock:
+        m = _maps.get(key)
+        if m is None:
+            if len(_maps) >= MAX_MAPPED_ARCHIVES:
+                return None
+            m = _maps[key] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return m
+
+
+class QuillArchive(object):
+    """
+    Open handle on a Quill tar archive
+
+    The member table is read once when the archive is opened and kept
+    as a name -> TarInfo map, so pages and blobs can be served without
+    scanning the tar headers again.
+
+    An uncompressed archive is also memory-mapped, and members are
+    returned as memoryview slices of the map instead of being copied.
+    Those slices keep the map alive after close(), so archives must be
+    replaced (written elsewhere and renamed) rather than rewritten in
+    place while they are in use. Archives of the same file share one
+    map, and at most MAX_MAPPED_ARCHIVES files are mapped at once.
+    Compressed archives, and uncompressed ones past that limit, are read
+    through tarfile and members are returned as bytes.
+    """
+    @staged('archive_open')
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._map = None
+        try:
+            self._tar = tarfile.open(filename, 'r:')
+        except tarfile.ReadError:
+            self._tar = tarfile.open(filename, 'r')
+        else:
+            with open(filename, 'rb') as f:
+                m = _map_archive(f)
+            if m is not None:
+                self._map = memoryview(m)
+        self._members = OrderedDict()
+        for f in self._tar.getmembers():
+            if f.isfile():
+                self._members.setdefault(f.name, f)
+        self._blob_index = None
+
+    def names(self):
+        """
+        Return the member names, in archive order
+        """
+        return list(self._members)
+
+    def __contains__(self, name):
+        return name in self._members
+
+    def getmember(self, name):
+        try:
+            return self._members[name]
+        except KeyError:
+            raise QuillImporterError('member ' + name + ' missing from Quill file')
+
+    def blob_index(self):
+        """
+        Return a map from the 36-character uuid prefix of each member's
+        base name to its TarInfo, built on first use.
+
+        Earlier members win, like a front-to-back scan of the archive.
+        """
+        if self._blob_index is None:
+            index = {}
+            for name, f in self._members.items():
+                index.setdefault(os.path.split(name)[-1][:UUID_LENGTH], f)
+            self._blob_index = index
+        return self._blob_index
+
+    def read(self, name):
+        """
+        Return the content of the member with the given name
+        """
+        return self.read_member(self.getmember(name))
+
+    def read_member(self, fileinfo):
+        """
+        Return the content of a member, as a memoryview of the mapped
+        archive if it is uncompressed, else as bytes
+        """
+        if self._map is not None and not fileinfo.issparse():
+            end = fileinfo.offset_data + fileinfo.size
+            if end > len(self._map):
+                raise QuillImporterError('failed to read ' + fileinfo.name)
+            count_work('tar_bytes', fileinfo.size)
+            return self._map[fileinfo.offset_data:end]
+        # The underlying file object is shared, so reads must not interleave
+        with self._lock, stage('tar_read'):
+            f = self._tar.extractfile(fileinfo)
+            try:
+                data = f.read()
+            except IOError:
+                raise QuillImporterError('failed to read ' + fileinfo.name)
+            finally:
+                f.close()
+        count_work('tar_bytes', len(data))
+        return data
+
+    def close(self):
+        self._tar.close()
+        # The map itself is unmapped once no member slice refers to it
+        self._map = None
+
+
 class QuillImporter(ImporterBase):
 
     def __init__(self,quill_filename):
         self._filename = quill_filename
-        with tarfile.open(self._filename, "r") as t:
-            self._open_quill_archive(t)
+        self._archive = QuillArchive(self._filename)
+        self._page_digests = {}
+        try:
+            self._open_quill_archive(self._archive)
+        except Exception:
+            self._archive.close()
+            raise
 
-    def _open_quill_archive(self,t):
+    def _open_quill_archive(self,archive):
         self._index = None
         index_files = []
 
         #List of tarfile
-        for f in t.getmembers():
-            if f.name.endswith('index') and not f.name.endswith('auto_index'):
-                index_files += [f,]
+        for name in archive.names():
+            if name.endswith('index') and not name.endswith('auto_index'):
+                index_files += [name,]
 
         if len(index_files) == 1: #case there is index file
-            self._index = QuillIndex(t.extractfile(index_files[0]))
+            self._index = QuillIndex(archive.read(index_files[0]))
             q = self._index
-            notebook_dir = os.path.split(index_files[0].name)[0]
+            notebook_dir = os.path.split(index_files[0])[0]
             self._page_filenames = [notebook_dir+'/page_'+page_uuid.decode('utf-8')+'.page' for page_uuid in q.page_uuids]
         else:
             self._page_filenames = []
-            for f in t.getmembers():
-                if f.name.endswith('.quill_data'):
-                    self._page_filenames += [f.name,]
+            for name in archive.names():
+                if name.endswith('.quill_data'):
+                    self._page_filenames += [name,]
+
+    def close(self):
+        self._archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def uuid(self):
         if self._index:
@@ -67,66 +230,82 @@ class QuillImporter(ImporterBase):
             return self._index.npages[0]
         return len(self._page_filenames)
 
-    def get_page(self,n):
+    def get_page(self,n,lazy=False):
         page_filename = self._page_filenames[n]
-        with tarfile.open(self._filename, 'r') as t:
-            page_file = t.extractfile(page_filename)
-            qp = QuillPage(page_file, QuillBlob(t))
+        page_data = self._archive.read(page_filename)
+        digest = self._page_digests.get(n)
+        if digest is None:
+            digest = self._page_digests.setdefault(n, hashlib.sha1(page_data).hexdigest())
+        return QuillPage(page_data, QuillBlob(self._archive), lazy, digest)
 
-        return qp
+    def iter_pages(self,lazy=False):
+        """
+        Parse and yield the pages one at a time, so that only the page
+        being worked on needs to be in memory
+        """
+        for n in range(self.n_pages()):
+            yield self.get_page(n,lazy)
+
+    def page_digest(self,n):
+        """
+        Return the SHA-1 hex digest of the n-th page record.
+
+        Any edit to the page changes it, so it can key caches of
+        anything derived from the page.
+        """
+        try:
+            return self._page_digests[n]
+        except KeyError:
+            digest = hashlib.sha1(self._archive.read(self._page_filenames[n])).hexdigest()
+            return self._page_digests.setdefault(n, digest)
 
 class QuillBlob(object):
     """
     Loader for contained binary objects (e.g. images)
     """
-    def __init__(self,tar):
-        self._tar = tar
+    def __init__(self,archive):
+        self._archive = archive
 
     def get(self, uuid):
         """
         Return the object with given uuid
         """
         fileinfo = self._find_uuid(uuid)
-        f = self._tar.extractfile(fileinfo)
-        try:
-            data = f.read()
-            return data
-        except IOError:
-            raise QuillImporterError('failed to read binary object')
-        finally:
-            f.close()
+        return self._archive.read_member(fileinfo)
 
     def _find_uuid(self, uuid):
         temp = uuid.decode('utf-8')
-        for f in self._tar.getmembers():
-            name = os.path.split(f.name)[-1]
-            if name.startswith(temp):
-                return f
+        fileinfo = self._archive.blob_index().get(temp[:UUID_LENGTH])
+        if fileinfo is not None and os.path.split(fileinfo.name)[-1].startswith(temp):
+            return fileinfo
         raise QuillImporterError('binary object missing from Quill file')
 
 
 class QuillIndex(object):
 
+    @staged('index_parse')
     def __init__(self, index_file):
         fp = index_file
-        self.version = struct.unpack(">i", fp.read(4))
+        if not isinstance(fp, PageReader):
+            fp = PageReader(fp)
+        header = fp.unpack(INDEX_HEADER)
+        self.version = header[:1]
         #Check all the current page version
         if not (self.version == (4,) or self.version == (7,)):
             raise QuillImporterError('wrong page version')
-        self.npages = struct.unpack(">i",fp.read(4))
+        self.npages = header[1:]
         self.page_uuids = []
 
         for x in range(self.npages[0]):
-            nbytes = struct.unpack(">h", fp.read(2))
+            nbytes = fp.unpack(SHORT)
             u = fp.read(36)
             self.page_uuids.append(u)
 
-        self.currentPage = struct.unpack(">i",fp.read(4))
-        nbytes = struct.unpack(">h", fp.read(2))
-        self.title = fp.read(nbytes[0]).decode('utf-8')
-        self.ctime = struct.unpack(">q", fp.read(8))
-        self.mtime = struct.unpack(">q", fp.read(8))
-        nbytes = struct.unpack(">h", fp.read(2))
+        self.currentPage = fp.unpack(INT)
+        self.title = fp.string()
+        self.ctime = fp.unpack(LONG)
+        self.mtime = fp.unpack(LONG)
+        nbytes = fp.unpack(SHORT)
         self.uuid = fp.read(36)
 
     def __repr__(self):
@@ -144,124 +323,285 @@ class QuillPage(object):
     pen_scale_factor = float(5.0/0.003)
 
     
+    # Size of the fixed records, used to step over sections in lazy mode
+    shape_record_size = INT.size + TOOL_INFO.size + SHAPE_BODY.size
+    image_record_size = INT.size + SHORT.size + 36 + IMAGE_BODY.size
+
+    # Container of each section; images and textboxes stay plain lists
+    section_types = {
+        'lines': LineArray,
+        'rectangles': RectangleArray,
+        'ovals': OvalArray,
+        'triangles': TriangleArray,
+        'tables': TableArray,
+        'strokes': StrokeArray,
+    }
+
+    def _new_section(self,name):
+        return self.section_types.get(name, list)()
+
+    def _read_records(self,name,fp,reader,count):
+        out = self._new_section(name)
+        for i in range(count):
+            reader(fp, out)
+        return out
+
+    def _section(self,name,fp,reader,skipper):
+        """
+        Read the count of a section and then either decode its records
+        or, for a lazy page, remember where they start and step over them.
+        """
+        count = fp.unpack(INT)
+        if count[0] < 0:
+            raise QuillImporterError('wrong number of ' + name)
+        if self._lazy:
+            self._sections[name] = (fp.tell(), count[0], reader)
+            self.__dict__.pop(name, None)
+            for i in range(count[0]):
+                skipper(fp)
+        else:
+            setattr(self, name, self._read_records(name, fp, reader, count[0]))
+        return count
+
+    def __getattr__(self,name):
+        # Only called for missing attributes: the sections not yet decoded
+        sections = self.__dict__.get('_sections')
+        if not sections or name not in sections:
+            raise AttributeError(name)
+        pos,count,reader = sections[name]
+        fp = self._reader.at(pos)
+        with stage('page_parse'):
+            items = self._read_records(name, fp, reader, count)
+        self._count_points()
+        self.__dict__[name] = items
+        self.grown()
+        return items
+
+    def _count_points(self):
+        # Reported once per parse rather than once per stroke
+        if self._points_read:
+            count_work('points', self._points_read)
+            self._points_read = 0
+
+    def on_growth(self,callback):
+        """
+        Have callback called whenever the footprint of the page changes,
+        e.g. when a display list, the spatial index or image data is added
+        """
+        self._growth_callback = callback
+
+    def grown(self):
+        callback = self.__dict__.get('_growth_callback')
+        if callback is not None:
+            callback()
+
+    # Rough per-object costs in bytes, for footprint()
+    object_overhead = 200
+
+    def footprint(self):
+        """
+        Return an approximation of the memory held by the page, in bytes.
+
+        Counts the primitive arrays (with the simplified strokes cached in
+        them), image data and a flat cost per image, textbox, display list
+        entry and spatial index entry. Sections of a lazy page that are not
+        decoded yet count as the page buffer they are read from.
+        """
+        size = self.object_overhead
+        if self._reader is not None:
+            size += len(self._reader._view)
+        d = self.__dict__
+        for name in self.section_types:
+            primitives = d.get(name)
+            if primitives is not None:
+                size += primitives.nbytes()
+        for image in d.get('images', ()):
+            data = image._data
+            size += self.object_overhead + (len(data) if data is not None else 0)
+        for textbox in d.get('textboxes', ()):
+            size += self.object_overhead + len(textbox.textStr())
+        for dl in d.get('_display_lists', {}).values():
+            size += self.object_overhead * len(dl)
+        index = d.get('_spatial_index')
+        if index is not None:
+            size += self.object_overhead * len(index)
+        return size
+
+    # The page sections held in the spatial index
+    indexed_sections = ('strokes', 'lines', 'rectangles', 'ovals', 'triangles', 'tables', 'images', 'textboxes')
+
+    def spatial_index(self):
+        """
+        Return a GridIndex of (section name, position) pairs over the
+        bounding boxes of the page primitives, built on first use.
+        Boxes of pen-drawn primitives include half their line width.
+        """
+        index = self.__dict__.get('_spatial_index')
+        if index is None:
+            index = GridIndex()
+            for name in self.indexed_sections:
+                for i, item in enumerate(getattr(self, name)):
+                    bbox = item.bbox()
+                    if bbox is None:
+                        continue
+                    if hasattr(item, 'thickness'):
+                        margin = item.thickness() / self.pen_scale_factor / 2
+                        bbox = (bbox[0] - margin, bbox[1] - margin, bbox[2] + margin, bbox[3] + margin)
+                    index.insert((name, i), bbox)
+            self._spatial_index = index
+            self.grown()
+        return index
+
+    def query_region(self,x0,y0,x1,y1,sections=None):
+        """
+        Return (section name, primitive) pairs for the primitives whose
+        bounding box meets the rectangle, optionally only from the given
+        sections
+        """
+        found = []
+        for name, i in self.spatial_index().query((x0, y0, x1, y1)):
+            if sections is None or name in sections:
+                found.append((name, getattr(self, name)[i]))
+        return found
+
+    def nearest_stroke(self,x,y,max_distance):
+        """
+        Return the stroke whose centre line passes closest to (x, y),
+        or None if there is none within max_distance
+        """
+        best = None
+        best_distance = max_distance
+        area = (x - max_distance, y - max_distance, x + max_distance, y + max_distance)
+        strokes = self.strokes
+        for name, i in self.spatial_index().query(area):
+            if name != 'strokes':
+                continue
+            stroke = strokes[i]
+            d = _distance_to_polyline(stroke.points(), x, y)
+            if d <= best_distance:
+                best = stroke
+                best_distance = d
+        return best
+
+    def skip_shape(self,fp):
+        fp.skip(self.shape_record_size)
+
+    skip_line = skip_rectangle = skip_oval = skip_triangle = skip_shape
+
+    def skip_image(self,fp):
+        fp.skip(self.image_record_size)
+
+    def skip_table(self,fp):
+        fp.skip(self.shape_record_size)
+        rowNum,colNum = fp.unpack(TABLE_SIZE)
+        fp.skip(FLOAT.size * (rowNum + colNum))
+
+    def skip_textbox(self,fp):
+        fp.skip(TEXTBOX_HEADER.size)
+        fp.skip(fp.unpack(SHORT)[0])
+        fp.skip(TEXTBOX_STYLE.size)
+
+    def skip_stroke(self,fp):
+        fp.skip(INT.size + TOOL_INFO.size)
+        N = fp.unpack(INT)
+        fp.skip(12 * N[0])
+
     def loadTagSet(self,fp):
-        self.tsversion = struct.unpack(">i", fp.read(4))
+        self.tsversion = fp.unpack(INT)
         if self.tsversion != (1,):
             raise QuillImporterError('wrong tag set version')
-        self.ntags = struct.unpack(">i", fp.read(4))
-        self.tags = [self.read_tag() for i in range (self.ntags[0])]
-        foo = struct.unpack(">i", fp.read(4))
-        foo = struct.unpack(">i", fp.read(4))
+        self.ntags = fp.unpack(INT)
+        self.tags = [self.read_tag(fp) for i in range (self.ntags[0])]
+        foo = fp.unpack(INT)
+        foo = fp.unpack(INT)
 
 
     def loadPage_v13(self,fp):
-        self.nimages = struct.unpack(">i", fp.read(4))
-        self.images = [ self.read_image() for i in range(self.nimages[0]) ]
+        self.nimages = self._section('images', fp, self.read_image, self.skip_image)
 
-        self.nlines = struct.unpack(">i", fp.read(4))
-        self.lines = [ self.read_line() for i in range(self.nlines[0]) ]
+        self.nlines = self._section('lines', fp, self.read_line, self.skip_line)
 
-        self.nRectangle = struct.unpack(">i", fp.read(4))
-        self.rectangles = [ self.read_rectangle() for i in range(self.nRectangle[0])]
+        self.nRectangle = self._section('rectangles', fp, self.read_rectangle, self.skip_rectangle)
 
-        self.nOval = struct.unpack(">i", fp.read(4))
-        self.ovals = [ self.read_oval() for i in range(self.nOval[0])]
+        self.nOval = self._section('ovals', fp, self.read_oval, self.skip_oval)
 
-        self.nTriangle = struct.unpack(">i", fp.read(4))
-        self.triangles =  [ self.read_triangle() for i in range(self.nTriangle[0])]
+        self.nTriangle = self._section('triangles', fp, self.read_triangle, self.skip_triangle)
 
-        self.nTable = struct.unpack(">i", fp.read(4))
-        self.tables = [self.read_table() for i in range(self.nTable[0])]
+        self.nTable = self._section('tables', fp, self.read_table, self.skip_table)
 
-        self.nstrokes = struct.unpack(">i", fp.read(4))
-        self.strokes = [ self.read_stroke() for i in range(self.nstrokes[0]) ]
+        self.nstrokes = self._section('strokes', fp, self.read_stroke, self.skip_stroke)
 
-    def read_tag(self):
-        fp = self.fp
-        self.tsversion = struct.unpack(">i", fp.read(4))
+    def read_tag(self,fp):
+        self.tversion = fp.unpack(INT)
         if self.tversion != (1,):
             raise QuillImporterError('wrong tag version')
-        nbytes = struct.unpack(">h", fp.read(2))
         tag = {}
-        tag["tag"] = fp.read(nbytes[0]).decode("utf-8")
-        tag["autogenerated"] = struct.unpack(">?", fp.read(1))[0]
-        tag["ctime"] = struct.unpack(">q", fp.read(8))[0]
-        foo = struct.unpack(">q", fp.read(8))
-
-    def read_textbox(self):
-        fp = self.fp
-        self.textbox_version = struct.unpack(">i", fp.read(4))
+        tag["tag"] = fp.string()
+        tag["autogenerated"] = fp.unpack(BOOL)[0]
+        tag["ctime"] = fp.unpack(LONG)[0]
+        foo = fp.unpack(LONG)
+        return tag
+
+    def read_textbox(self,fp,out):
+        version,tool,left,right,top,bottom = fp.unpack(TEXTBOX_HEADER)
+        self.textbox_version = (version,)
         if self.textbox_version != (1,):
             raise QuillImporterError('wrong textbox version')
 
-        self.textbox_tool = struct.unpack(">i", fp.read(4))
+        self.textbox_tool = (tool,)
         if self.textbox_tool != (4,):
             raise QuillImporterError('wrong tool textbox version')
 
-        left = struct.unpack(">f", fp.read(4))
-        right = struct.unpack(">f", fp.read(4))
-        top = struct.unpack(">f", fp.read(4))
-        bottom = struct.unpack(">f", fp.read(4))
+        textStr = fp.string()
 
-        nbytes = struct.unpack(">h", fp.read(2))
-        textStr = fp.read(nbytes[0]).decode("utf-8")
+        textFontSize,textColor,isBold,isItalic,isUnderline = fp.unpack(TEXTBOX_STYLE)
 
-        textFontSize = struct.unpack(">i", fp.read(4))
-        textColor = struct.unpack(">I", fp.read(4))
+        red = (textColor >> 16) & 0xFF
+        green = (textColor >> 8) & 0xFF
+        blue = textColor & 0xFF
 
-        red = (textColor[0] >> 16) & 0xFF
-        green = (textColor[0] >> 8) & 0xFF
-        blue = textColor[0] & 0xFF
+        out.append(TextBox(red,green,blue,left,right,top,bottom,textStr,textFontSize,isBold,isItalic,isUnderline))
 
-        isBold = struct.unpack(">?", fp.read(1))
-        isItalic = struct.unpack(">?", fp.read(1))
-        isUnderline = struct.unpack(">?", fp.read(1))
-
-        return TextBox(red,green,blue,left[0],right[0],top[0],bottom[0],textStr,textFontSize[0],isBold[0],isItalic[0],isUnderline[0])
-
-    def read_image(self):
-        fp = self.fp
-        self.image_version = struct.unpack(">i", fp.read(4))
+    def read_image(self,fp,out):
+        self.image_version = fp.unpack(INT)
         if self.image_version != (1,):
             raise QuillImporterError('wrong version of image')
 
-        uuid_nbytes = struct.unpack(">h", fp.read(2))
+        uuid_nbytes = fp.unpack(SHORT)
         uuid = fp.read(36)
 
-        top_left = struct.unpack(">f", fp.read(4))
-        top_right = struct.unpack(">f", fp.read(4))
-        bottom_left = struct.unpack(">f", fp.read(4))
-        bottom_right = struct.unpack(">f", fp.read(4))
-        constrain_aspect = struct.unpack(">?", fp.read(1))
+        top_left,top_right,bottom_left,bottom_right,constrain_aspect = fp.unpack(IMAGE_BODY)
 
-        return Image(uuid,top_left[0],top_right[0],bottom_left[0],bottom_right[0],constrain_aspect[0],self._blob_loader.get(uuid))
+        if self._lazy:
+            # Leave the blob in the archive until Image.data() is called
+            out.append(Image(uuid,top_left,top_right,bottom_left,bottom_right,constrain_aspect,None,
+                             data_loader=functools.partial(self._blob_loader.get, uuid),
+                             on_load=self.grown))
+        else:
+            out.append(Image(uuid,top_left,top_right,bottom_left,bottom_right,constrain_aspect,self._blob_loader.get(uuid)))
 
     
     def getToolInfo(self,fp):
-        pen_color = struct.unpack(">I", fp.read(4))
-        red = (pen_color[0] >> 16) & 0xFF
-        green = (pen_color[0] >> 8) & 0xFF
-        blue = pen_color[0] & 0xFF
-        thickness = struct.unpack(">i", fp.read(4))
-        toolint = struct.unpack(">i", fp.read(4))
-        return (red,green,blue,thickness,toolint)
-
-    def read_line(self):
-        fp = self.fp
-        self.line_version = struct.unpack(">i", fp.read(4))
-        if version != (1,):
+        pen_color,thickness,toolint = fp.unpack(TOOL_INFO)
+        red = (pen_color >> 16) & 0xFF
+        green = (pen_color >> 8) & 0xFF
+        blue = pen_color & 0xFF
+        return (red,green,blue,(thickness,),(toolint,))
+
+    def read_line(self,fp,out):
+        self.line_version = fp.unpack(INT)
+        if self.line_version != (1,):
             raise QuillImporterError('wrong version of line')
 
         red,green,blue,thickness,toolint = self.getToolInfo(fp)
         if toolint != (5,):
             raise QuillImporterError('wrong line tool')
 
-        xy = struct.unpack(">ffff", fp.read(4*4))
-        return Line(red,green,blue,thickness[0],xy[0],xy[1],xy[2],xy[3])
+        xy = fp.unpack(SHAPE_BODY)
+        out.add(thickness[0],red,green,blue,xy[0],xy[1],xy[2],xy[3])
 
-    def read_rectangle(self):
-        fp = self.fp
-        self.rectangle_version = struct.unpack(">i", fp.read(4))
+    def read_rectangle(self,fp,out):
+        self.rectangle_version = fp.unpack(INT)
         if self.rectangle_version != (1,):
             raise QuillImporterError('wrong version of rectangle')
 
@@ -269,15 +609,11 @@ class QuillPage(object):
         if toolint != (10,):
             raise QuillImporterError('wrong rectangle tool')
 
-        top_left = struct.unpack(">f", fp.read(4))
-        top_right = struct.unpack(">f", fp.read(4))
-        bottom_left = struct.unpack(">f", fp.read(4))
-        bottom_right = struct.unpack(">f", fp.read(4))
-        return Rectangle(thickness[0],red,green,blue,top_left[0],top_right[0],bottom_left[0],bottom_right[0])
+        top_left,top_right,bottom_left,bottom_right = fp.unpack(SHAPE_BODY)
+        out.add(thickness[0],red,green,blue,top_left,top_right,bottom_left,bottom_right)
 
-    def read_oval(self):
-        fp = self.fp
-        self.oval_version = struct.unpack(">i", fp.read(4))
+    def read_oval(self,fp,out):
+        self.oval_version = fp.unpack(INT)
         if self.oval_version != (1,):
             raise QuillImporterError('wrong version of oval')
 
@@ -285,16 +621,12 @@ class QuillPage(object):
         if toolint != (11,):
             raise QuillImporterError('wrong oval tool')
 
-        top_right = struct.unpack(">f", fp.read(4))
-        top_left = struct.unpack(">f", fp.read(4))
-        bottom_left =struct.unpack(">f", fp.read(4))
-        bottom_right = struct.unpack(">f", fp.read(4))
+        top_right,top_left,bottom_left,bottom_right = fp.unpack(SHAPE_BODY)
 
-        return Oval(thickness[0],red,green,blue,top_left[0],top_right[0],bottom_left[0],bottom_right[0])
+        out.add(thickness[0],red,green,blue,top_left,top_right,bottom_left,bottom_right)
 
-    def read_triangle(self):
-        fp = self.fp
-        self.triangle_version = struct.unpack(">i", fp.read(4))
+    def read_triangle(self,fp,out):
+        self.triangle_version = fp.unpack(INT)
         if self.triangle_version != (1,):
             raise QuillImporterError('wrong version of triangle')
 
@@ -302,15 +634,11 @@ class QuillPage(object):
         if toolint != (12,):
             raise QuillImporterError('wrong triangle tool')
 
-        top_left = struct.unpack(">f", fp.read(4))
-        top_right = struct.unpack(">f", fp.read(4))
-        bottom_left = struct.unpack(">f", fp.read(4))
-        bottom_right = struct.unpack(">f", fp.read(4))
-        return Triangle(thickness[0],red,green,blue,top_left[0],top_right[0],bottom_left[0],bottom_right[0])
+        top_left,top_right,bottom_left,bottom_right = fp.unpack(SHAPE_BODY)
+        out.add(thickness[0],red,green,blue,top_left,top_right,bottom_left,bottom_right)
 
-    def read_table(self):
-        fp = self.fp
-        self.table_version = struct.unpack(">i", fp.read(4))
+    def read_table(self,fp,out):
+        self.table_version = fp.unpack(INT)
         if self.table_version != (1,):
             raise QuillImporterError('wrong version of table')
 
@@ -318,26 +646,17 @@ class QuillPage(object):
         if toolint != (15,):
             raise QuillImporterError('wrong table tool')
 
-        top_left = struct.unpack(">f", fp.read(4))
-        top_right = struct.unpack(">f", fp.read(4))
-        bottom_left = struct.unpack(">f", fp.read(4))
-        bottom_right = struct.unpack(">f", fp.read(4))
-        rowNum = struct.unpack(">i", fp.read(4))
-        colNum = struct.unpack(">i", fp.read(4))
-        rowPercentHeight = []
-        colPercentWidth = []
-
-        for i in range(rowNum[0]):
-            rowPercentHeight += [struct.unpack(">f", fp.read(4))[0],]
+        top_left,top_right,bottom_left,bottom_right = fp.unpack(SHAPE_BODY)
+        rowNum,colNum = fp.unpack(TABLE_SIZE)
+        if rowNum < 0 or colNum < 0:
+            raise QuillImporterError('wrong table size')
+        rowPercentHeight = fp.unpack(struct.Struct('>%df' % rowNum))
+        colPercentWidth = fp.unpack(struct.Struct('>%df' % colNum))
 
-        for i in range(colNum[0]):
-            colPercentWidth += [struct.unpack(">f", fp.read(4))[0],]
+        out.add(thickness[0],red,green,blue,top_left,top_right,bottom_left,bottom_right,rowPercentHeight,colPercentWidth)
 
-        return Table(thickness[0],red,green,blue,top_left[0],top_right[0],bottom_left[0],bottom_right[0],rowPercentHeight,colPercentWidth)
-
-    def read_stroke(self):
-        fp = self.fp
-        self.stroke_version = struct.unpack(">i", fp.read(4))
+    def read_stroke(self,fp,out):
+        self.stroke_version = fp.unpack(INT)
         v = self.stroke_version[0]
         if v < 1 or v > 3:
             raise QuillImporterError('wrong version of stroke')
@@ -347,137 +666,161 @@ class QuillPage(object):
         if toolint[0] < 0 or toolint[0]>=17:
             raise QuillImporterError('wrong stroke tool')
 
-        N = struct.unpack(">i", fp.read(4))
-        points = []
-        for i in range(N[0]):
-            x = struct.unpack(">f", fp.read(4))
-            y = struct.unpack(">f", fp.read(4))
-            p = struct.unpack(">f", fp.read(4))
-            points.append((x[0], y[0], p[0]))
-
-        return Stroke(thickness[0],red,green,blue,fountain_pen,points)
-
-    def __init__(self,page_file,blob_loader):
-        self.lines = []
-        self.ovals = []
-        self.triangles = []
-        self.rectangles = []
-        self.tables = []
-        self.strokes = []
+        N = fp.unpack(INT)
+        if N[0] < 0:
+            raise QuillImporterError('truncated stroke')
+        out.add(thickness[0],red,green,blue,fountain_pen,fp.view(12 * N[0]))
+        self._points_read += N[0]
+
+    @staged('page_parse')
+    def __init__(self,page_file,blob_loader,lazy=False,digest=None):
+        """
+        With lazy=True only the page header is decoded. The shape, stroke,
+        image and textbox lists are decoded on first access, and image
+        blobs are only read from the archive when their data is asked for.
+
+        digest is the content digest of the page record, if known.
+        """
+        self._lazy = lazy
+        self.digest = digest
+        self._sections = {}
+        self._points_read = 0
+        self.lines = LineArray()
+        self.ovals = OvalArray()
+        self.triangles = TriangleArray()
+        self.rectangles = RectangleArray()
+        self.tables = TableArray()
+        self.strokes = StrokeArray()
         self.images = []
         self.textboxes = []
 
         self._blob_loader = blob_loader
-        print("These are info about the page\n")
-        fp = self.fp = page_file
-        self.version = struct.unpack(">i", fp.read(4))
-        print(self.version)
+        # Accept raw bytes, a file object, or a reader positioned at the page
+        fp = page_file
+        if not hasattr(fp, 'unpack'):
+            if hasattr(fp, 'read'):
+                fp = fp.read()
+            fp = PageReader(fp)
+        self.fp = fp
+        self._reader = fp
+        self.version = fp.unpack(INT)
+        debug('Quill page version %d', self.version[0])
         v = self.version[0]
         if v < 0 and v > 14:
             raise QuillImporterError('Wrong page version')
         #Handle all the version of the page
         if v == 2:
-            self.paper_type = struct.unpack(">i", fp.read(4))
-            foo = struct.unpack(">i", fp.read(4))
-            foo = struct.unpack(">i", fp.read(4))
+            self.paper_type = fp.unpack(INT)
+            foo = fp.unpack(INT)
+            foo = fp.unpack(INT)
         elif v == 3:
             self.loadTagSet(fp)
-            self.paper_type = struct.unpack(">i", fp.read(4))
-            foo = struct.unpack(">i", fp.read(4))
-            foo = struct.unpack(">i", fp.read(4))
+            self.paper_type = fp.unpack(INT)
+            foo = fp.unpack(INT)
+            foo = fp.unpack(INT)
         elif v == 4 or v == 5:
-            nbytes = struct.unpack(">h", fp.read(2))
+            nbytes = fp.unpack(SHORT)
             self.uuid = fp.read(36)
             self.loadTagSet(fp)
-            self.paper_type = struct.unpack(">i", fp.read(4))
-            foo = struct.unpack(">i", fp.read(4))
-            foo = struct.unpack(">i", fp.read(4))
+            self.paper_type = fp.unpack(INT)
+            foo = fp.unpack(INT)
+            foo = fp.unpack(INT)
         elif v >= 6:
-            nbytes = struct.unpack(">h", fp.read(2))
+            nbytes = fp.unpack(SHORT)
             self.uuid = fp.read(36)
             self.loadTagSet(fp)
-            self.paper_type = struct.unpack(">i", fp.read(4))
+            self.paper_type = fp.unpack(INT)
             if (v < 13):
-                self.nimages = struct.unpack(">i", fp.read(4))
-                self.images = [ self.read_image() for i in range(self.nimages[0]) ]
-            foo = struct.unpack(">i", fp.read(4))
+                self.nimages = self._section('images', fp, self.read_image, self.skip_image)
+            foo = fp.unpack(INT)
 
         if v < 13:
-            self.read_only = struct.unpack(">?", fp.read(1))
-            self.aspect_ratio = struct.unpack(">f", fp.read(4))[0]
+            self.read_only = fp.unpack(BOOL)
+            self.aspect_ratio = fp.unpack(FLOAT)[0]
 
-            self.nstrokes = struct.unpack(">i", fp.read(4))
-            self.strokes = [ self.read_stroke() for i in range(self.nstrokes[0]) ]
+            self.nstrokes = self._section('strokes', fp, self.read_stroke, self.skip_stroke)
 
             if v >= 5:
-                self.nlines = struct.unpack(">i", fp.read(4))
-                self.lines = [ self.read_line() for i in range(self.nlines[0]) ]
+                self.nlines = self._section('lines', fp, self.read_line, self.skip_line)
 
                 if v >= 8:
-                    self.nRectangle = struct.unpack(">i", fp.read(4))
-                    self.rectangles = [ self.read_rectangle() for i in range(self.nRectangle[0])]
+                    self.nRectangle = self._section('rectangles', fp, self.read_rectangle, self.skip_rectangle)
 
                     if v >= 9:
-                        self.nOval = struct.unpack(">i", fp.read(4))
-                        self.ovals = [ self.read_oval() for i in range(self.nOval[0])]
+                        self.nOval = self._section('ovals', fp, self.read_oval, self.skip_oval)
 
-                        self.nTriangle = struct.unpack(">i", fp.read(4))
-                        self.triangles =  [ self.read_triangle() for i in range(self.nTriangle[0])]
+                        self.nTriangle = self._section('triangles', fp, self.read_triangle, self.skip_triangle)
 
-                foo = struct.unpack(">i", fp.read(4))
-                foo = struct.unpack(">i", fp.read(4)) #nText
+                foo = fp.unpack(INT)
+                foo = fp.unpack(INT) #nText
 
                 if v >= 7:
-                    nbytes = struct.unpack(">h", fp.read(2))
-                    self.paper_path = fp.read(nbytes[0]).decode("utf-8")
+                    self.paper_path = fp.string()
 
                     if v >= 10:
-                        nbytes = struct.unpack(">h", fp.read(2))
-                        self.mainTag = fp.read(nbytes[0]).decode("utf-8")
+                        self.mainTag = fp.string()
 
                         if v >= 11:
-                            self.nTextBox = struct.unpack(">i", fp.read(4))
-                            self.textboxes = [self.read_textbox() for i in range(self.nTextBox[0])]
+                            self.nTextBox = self._section('textboxes', fp, self.read_textbox, self.skip_textbox)
 
                         if v >= 12:
-                            self.nTable = struct.unpack(">i", fp.read(4))
-                            self.tables = [self.read_table() for i in range(self.nTable[0])]
+                            self.nTable = self._section('tables', fp, self.read_table, self.skip_table)
 
         else:
-            self.read_only = struct.unpack(">?", fp.read(1))
-            self.aspect_ratio = struct.unpack(">f", fp.read(4))[0]
-            foo = struct.unpack(">i", fp.read(4))
+            self.read_only = fp.unpack(BOOL)
+            self.aspect_ratio = fp.unpack(FLOAT)[0]
+            foo = fp.unpack(INT)
             
-            nbytes = struct.unpack(">h", fp.read(2))
-            self.paper_path = fp.read(nbytes[0]).decode("utf-8")
-            foo = struct.unpack(">i", fp.read(4))
+            self.paper_path = fp.string()
+            foo = fp.unpack(INT)
             
-            nbytes = struct.unpack(">h", fp.read(2))
-            self.mainTag = fp.read(nbytes[0]).decode("utf-8")
-            foo = struct.unpack(">i", fp.read(4))
+            self.mainTag = fp.string()
+            foo = fp.unpack(INT)
 
-            nbytes =  struct.unpack(">h", fp.read(2))
-            self.timeStamp = fp.read(nbytes[0]).decode("utf-8")
+            self.timeStamp = fp.string()
 
-            self.nTextBox = struct.unpack(">i", fp.read(4))
-            self.textboxes = [self.read_textbox() for i in range(self.nTextBox[0])]
+            self.nTextBox = self._section('textboxes', fp, self.read_textbox, self.skip_textbox)
 
             if v >= 14:
-                self.isRecognized = struct.unpack(">?", fp.read(1))
-                self.ocr_version = struct.unpack(">i", fp.read(4))
+                self.isRecognized = fp.unpack(BOOL)
+                self.ocr_version = fp.unpack(INT)
                 
-                nbytes = struct.unpack(">h", fp.read(2))
-                self.ocr_language = fp.read(nbytes[0]).decode("utf-8")
+                self.ocr_language = fp.string()
 
-                nbytes = struct.unpack(">h", fp.read(2))
-                self.ocr_textStr = fp.read(nbytes[0]).decode("utf-8")
+                self.ocr_textStr = fp.string()
 
-                self.ocr_textFontSize = struct.unpack(">i", fp.read(4))
-                self.ocr_isBold = struct.unpack(">?", fp.read(1))
-                self.ocr_isItalic = struct.unpack(">?", fp.read(1))
-                self.ocr_isUnderline = struct.unpack(">?", fp.read(1))
+                self.ocr_textFontSize = fp.unpack(INT)
+                self.ocr_isBold = fp.unpack(BOOL)
+                self.ocr_isItalic = fp.unpack(BOOL)
+                self.ocr_isUnderline = fp.unpack(BOOL)
 
             self.loadPage_v13(fp)
 
+        self._count_points()
+        if not lazy:
+            # Everything is decoded, the page buffer is no longer needed
+            self.fp = self._reader = None
 
-
+    @classmethod
+    def from_sections(cls,sections,aspect_ratio,version,uuid=None,digest=None):
+        """
+        Return a page made of already decoded sections, a map from
+        section name ('strokes', 'images', ...) to its container.
+        Missing sections are empty.
+        """
+        page = cls.__new__(cls)
+        page._lazy = False
+        page.digest = digest
+        page._sections = {}
+        page._points_read = 0
+        page._blob_loader = None
+        page.fp = page._reader = None
+        page.version = version
+        page.uuid = uuid
+        page.aspect_ratio = aspect_ratio
+        for name in cls.indexed_sections:
+            setattr(page, name, sections[name] if name in sections else page._new_section(name))
+        for image in page.images:
+            if image._data is None:
+                image._on_load = page.grown
+        return page
@@ -26,6 +26,9 @@ class Rectangle(ColorTool):
 		s += 'bottom: ' + str(self._bottom) + '\n'
 		return s
 
+	def bbox(self):
+		return (min(self._left,self._right),min(self._top,self._bottom),max(self._left,self._right),max(self._top,self._bottom))
+
 	def left(self):
 		return self._left
 
@@ -0,0 +1,79 @@
+"""
+Stroke simplification for level-of-detail rendering
+
+Strokes are simplified with the Douglas-Peucker algorithm. A point is
+kept if dropping it would move the line by more than the tolerance, or,
+for strokes drawn with pressure, if its pressure differs from the one
+interpolated along the simplified segment by more than the pressure
+tolerance (so the width profile survives).
+"""
+
+import math
+from array import array
+
+# Largest pressure error allowed when a point is dropped
+PRESSURE_TOLERANCE = 0.05
+
+
+def tolerance_bucket(tolerance):
+    """
+    Return the power-of-two bucket of a tolerance. Simplifying with
+    2 ** bucket is never coarser than the tolerance asked for.
+    """
+    return int(math.floor(math.log2(tolerance)))
+
+
+def simplify_points(points, tolerance, pressure=False, pressure_tolerance=PRESSURE_TOLERANCE):
+    """
+    Simplify a flat (x, y, pressure) float array. Return the kept
+    points as a new array of the same layout, or points itself if no
+    point can be dropped.
+    """
+    n = len(points) // 3
+    if n < 3:
+        return points
+    keep = bytearray(n)
+    keep[0] = keep[n - 1] = 1
+    tol2 = tolerance * tolerance
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        ax, ay, ap = points[3*first], points[3*first+1], points[3*first+2]
+        dx = points[3*last] - ax
+        dy = points[3*last+1] - ay
+        dp = points[3*last+2] - ap
+        length2 = dx*dx + dy*dy
+        worst = 1.0
+        worst_index = -1
+        for k in range(first + 1, last):
+            px = points[3*k] - ax
+            py = points[3*k+1] - ay
+            t = 0.0
+            if length2 > 0:
+                t = (px*dx + py*dy) / length2
+                if t < 0.0:
+                    t = 0.0
+                elif t > 1.0:
+                    t = 1.0
+            ex = px - t*dx
+            ey = py - t*dy
+            error = (ex*ex + ey*ey) / tol2
+            if pressure:
+                perr = abs(points[3*k+2] - (ap + t*dp)) / pressure_tolerance
+                error = max(error, perr*perr)
+            if error > worst:
+                worst = error
+                worst_index = k
+        if worst_index >= 0:
+            keep[worst_index] = 1
+            stack.append((first, worst_index))
+            stack.append((worst_index, last))
+    if all(keep):
+        return points
+    simplified = array('f')
+    for k in range(n):
+        if keep[k]:
+            simplified.extend(points[3*k:3*k+3])
+    return simplified
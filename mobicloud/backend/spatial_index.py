@@ -0,0 +1,81 @@
+"""
+Uniform grid index over the bounding boxes of page primitives
+
+Boxes are (x0, y0, x1, y1) rectangles in page units. Each entry is
+filed under every grid cell its box touches; boxes that would cover too
+many cells (or are unbounded) are kept in a separate list that every
+query checks.
+"""
+
+import math
+
+
+class GridIndex(object):
+
+    # Entries covering more cells than this are not filed in the grid
+    max_cells = 256
+
+    def __init__(self, cell_size=1.0/32):
+        self._cell = float(cell_size)
+        self._cells = {}
+        self._large = []
+        self._boxes = []
+        self._values = []
+
+    def __len__(self):
+        return len(self._values)
+
+    def _cell_range(self, bbox):
+        c = self._cell
+        return (int(math.floor(bbox[0] / c)), int(math.floor(bbox[1] / c)),
+                int(math.floor(bbox[2] / c)), int(math.floor(bbox[3] / c)))
+
+    def insert(self, value, bbox):
+        n = len(self._values)
+        self._values.append(value)
+        self._boxes.append(bbox)
+        if not all(math.isfinite(v) for v in bbox):
+            self._large.append(n)
+            return
+        cx0, cy0, cx1, cy1 = self._cell_range(bbox)
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > self.max_cells:
+            self._large.append(n)
+            return
+        cells = self._cells
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                cells.setdefault((cx, cy), []).append(n)
+
+    def _candidates(self, area):
+        found = set(self._large)
+        cx0, cy0, cx1, cy1 = self._cell_range(area)
+        cells = self._cells
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(cells):
+            # Cheaper to look at the occupied cells than at the area
+            for (cx, cy), entries in cells.items():
+                if cx0 <= cx <= cx1 and cy0 <= cy <= cy1:
+                    found.update(entries)
+        else:
+            for cx in range(cx0, cx1 + 1):
+                for cy in range(cy0, cy1 + 1):
+                    entries = cells.get((cx, cy))
+                    if entries:
+                        found.update(entries)
+        return found
+
+    def query_indices(self, area):
+        """
+        Return the insertion numbers of the entries whose box meets
+        area, in insertion order
+        """
+        boxes = self._boxes
+        x0, y0, x1, y1 = area
+        return sorted(n for n in self._candidates(area)
+                      if boxes[n][0] <= x1 and x0 <= boxes[n][2] and boxes[n][1] <= y1 and y0 <= boxes[n][3])
+
+    def query(self, area):
+        """
+        Return the values whose box meets area, in insertion order
+        """
+        values = self._values
+        return [values[n] for n in self.query_indices(area)]
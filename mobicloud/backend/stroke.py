@@ -1,22 +1,68 @@
 '''
 Class for Stroke object
 
+The points are kept in one flat float32 array laid out as
+x0, y0, p0, x1, y1, p1, ...
 '''
 
-fromcolor_tool import ColorTool
+import sys
+from array import array
+
+from color_tool import ColorTool
+from backend.simplify import simplify_points
+
+def points_from_bytes(data):
+	'''
+	Decode a block of big-endian (x, y, pressure) float32 triples
+	'''
+	points = array('f')
+	points.frombytes(data)
+	if sys.byteorder == 'little':
+		points.byteswap()
+	return points
 
 class Stroke(ColorTool):
 
 	def __init__(self,thickness,red,green,blue,pressure,points):
 		super(Stroke,self).__init__(red,green,blue,thickness)
 		self._pressure = pressure
-		self._points = tuple(points)
+		if not isinstance(points, array):
+			points = array('f', [c for point in points for c in point])
+		self._points = points
+		if len(points) >= 3:
+			xs = points[0::3]
+			ys = points[1::3]
+			self._bbox = (min(xs),min(ys),max(xs),max(ys))
+		else:
+			self._bbox = None
+		self._lod = None
 
 	def get_point(self,i):
-		return self._points[i]
+		if i < 0:
+			i += self.n_points()
+		p = self._points
+		return (p[3*i], p[3*i+1], p[3*i+2])
 
 	def n_points(self):
-		return len(self._points)
+		return len(self._points) // 3
+
+	def points(self):
+		return self._points
+
+	def simplified(self,bucket):
+		'''
+		Return the points simplified to a tolerance of 2**bucket page
+		units, computed once per bucket
+		'''
+		if self._lod is None:
+			self._lod = {}
+		points = self._lod.get(bucket)
+		if points is None:
+			points = self._lod[bucket] = simplify_points(self._points,2.0**bucket,self._pressure)
+		return points
+
+	def bbox(self):
+		return self._bbox
 
 	def thickness(self):
 		color_tool = super(Stroke,self)
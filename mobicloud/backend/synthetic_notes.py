@@ -0,0 +1,174 @@
+"""
+Generator of synthetic Quill notebooks
+
+Writes notebooks of any size with QuillExporter, to reproduce large or
+dense production notes locally: the number of pages, strokes per page,
+points per stroke, shapes, pictures and their pixel size, and words of
+text are all configurable. Strokes are smooth random pen paths with a
+varying pressure. The same seed always gives the same notebook.
+
+    python -m backend.synthetic_notes big.note --pages 200 --strokes 300 --points 200
+"""
+
+import argparse
+import math
+import random
+import uuid as uuid_module
+from array import array
+
+from backend.quill_export import QuillExporter, PageContent, DEFAULT_ASPECT_RATIO
+from backend.stroke import Stroke
+from backend.line import Line
+from backend.rectangle import Rectangle
+from backend.oval import Oval
+from backend.triangle import Triangle
+from backend.table import Table
+from backend.textbox import TextBox
+from backend.image import Image
+
+# Pen colours the strokes and shapes are drawn with
+PALETTE = ((0, 0, 0), (0, 0, 160), (180, 0, 0), (0, 120, 0), (90, 90, 90))
+
+# Distance, in page units, between consecutive points of a stroke
+STEP = 0.002
+
+# Words per text box; longer texts are spread over several boxes
+WORDS_PER_TEXTBOX = 80
+
+VOCABULARY = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+              'incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud '
+              'exercitation ullamco laboris nisi aliquip ex ea commodo consequat').split()
+
+
+def random_stroke(rng, aspect_ratio, n_points, pressure=True):
+    """
+    Return a Stroke following a smooth random path inside the page
+    """
+    x = rng.uniform(0.05, aspect_ratio - 0.05)
+    y = rng.uniform(0.05, 0.95)
+    heading = rng.uniform(0, 2 * math.pi)
+    p = rng.uniform(0.3, 1.0)
+    points = array('f')
+    for i in range(n_points):
+        points.extend((x, y, p))
+        heading += rng.gauss(0, 0.3)
+        x = min(max(x + STEP * math.cos(heading), 0.0), aspect_ratio)
+        y = min(max(y + STEP * math.sin(heading), 0.0), 1.0)
+        if pressure:
+            p = min(max(p + rng.gauss(0, 0.05), 0.1), 1.0)
+    red, green, blue = rng.choice(PALETTE)
+    return Stroke(rng.choice((3, 5, 8)), red, green, blue, pressure, points)
+
+
+def _random_box(rng, aspect_ratio, max_size=0.3):
+    left = rng.uniform(0, aspect_ratio - max_size)
+    top = rng.uniform(0, 1 - max_size)
+    return left, left + rng.uniform(0.02, max_size), top, top + rng.uniform(0.02, max_size)
+
+
+def add_random_shape(rng, page, kind):
+    """
+    Append a shape of the given kind (one of 'lines', 'rectangles',
+    'ovals', 'triangles' and 'tables') at a random place of the page
+    """
+    red, green, blue = rng.choice(PALETTE)
+    thickness = rng.choice((3, 5, 8))
+    left, right, top, bottom = _random_box(rng, page.aspect_ratio)
+    if kind == 'lines':
+        page.lines.append(Line(red, green, blue, thickness, left, top, right, bottom))
+    elif kind == 'rectangles':
+        page.rectangles.append(Rectangle(thickness, red, green, blue, left, right, top, bottom))
+    elif kind == 'ovals':
+        page.ovals.append(Oval(thickness, red, green, blue, left, right, top, bottom))
+    elif kind == 'triangles':
+        page.triangles.append(Triangle(thickness, red, green, blue, left, right, top, bottom))
+    elif kind == 'tables':
+        rows = [i / 4.0 for i in range(1, 4)]
+        cols = [i / 3.0 for i in range(1, 3)]
+        page.tables.append(Table(thickness, red, green, blue, left, right, top, bottom, rows, cols))
+    else:
+        raise ValueError('unknown shape ' + repr(kind))
+
+
+SHAPE_KINDS = ('lines', 'rectangles', 'ovals', 'triangles', 'tables')
+
+
+def random_text(rng, n_words):
+    return ' '.join(rng.choice(VOCABULARY) for i in range(n_words))
+
+
+def random_jpeg(rng, width, height):
+    """
+    Return JPEG data of noise, which compresses about as badly as a photo
+    """
+    import gi
+    gi.require_version('GdkPixbuf', '2.0')
+    from gi.repository import GdkPixbuf, GLib
+    pixels = bytes(rng.getrandbits(8) for i in range(width * height * 3))
+    pixbuf = GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(pixels), GdkPixbuf.Colorspace.RGB,
+                                             False, 8, width, height, width * 3)
+    ok, data = pixbuf.save_to_bufferv('jpeg', ['quality'], ['90'])
+    return data
+
+
+def random_page(rng, strokes=100, points=100, shapes=0, images=0, image_size=(640, 480),
+                words=0, pressure=True, aspect_ratio=DEFAULT_ASPECT_RATIO):
+    """
+    Return a PageContent filled with the given numbers of primitives
+    """
+    page = PageContent(aspect_ratio)
+    for i in range(shapes):
+        add_random_shape(rng, page, SHAPE_KINDS[i % len(SHAPE_KINDS)])
+    for i in range(images):
+        left, right, top, bottom = _random_box(rng, aspect_ratio, 0.5)
+        image_uuid = str(uuid_module.UUID(int=rng.getrandbits(128), version=4))
+        page.images.append(Image(image_uuid.encode('utf-8'), left, right, top, bottom, True,
+                                 random_jpeg(rng, image_size[0], image_size[1])))
+    top = 0.05
+    while words > 0:
+        n = min(words, WORDS_PER_TEXTBOX)
+        words -= n
+        red, green, blue = rng.choice(PALETTE)
+        page.textboxes.append(TextBox(red, green, blue, 0.05, aspect_ratio - 0.05, top, top + 0.1,
+                                      random_text(rng, n), 12, False, False, False))
+        top = min(top + 0.12, 0.85)
+    for i in range(strokes):
+        page.strokes.append(random_stroke(rng, aspect_ratio, points, pressure))
+    return page
+
+
+def generate_notebook(filename, pages=10, seed=0, title='Synthetic notebook', **page_options):
+    """
+    Write a notebook of the given number of random pages; page_options
+    are passed on to random_page(). Return the notebook uuid.
+    """
+    rng = random.Random(seed)
+    notebook_uuid = str(uuid_module.UUID(int=rng.getrandbits(128), version=4))
+    with QuillExporter(filename, title, notebook_uuid, ctime=0, mtime=0) as exporter:
+        for n in range(pages):
+            page_uuid = str(uuid_module.UUID(int=rng.getrandbits(128), version=4))
+            exporter.add_page(random_page(rng, **page_options), page_uuid)
+    return notebook_uuid
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic Quill notebook.')
+    parser.add_argument('filename')
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--strokes', type=int, default=100, help='strokes per page')
+    parser.add_argument('--points', type=int, default=100, help='points per stroke')
+    parser.add_argument('--shapes', type=int, default=0, help='lines, rectangles, ovals, triangles and tables per page')
+    parser.add_argument('--images', type=int, default=0, help='pictures per page')
+    parser.add_argument('--image-size', default='640x480', help='pixel size of the pictures, WIDTHxHEIGHT')
+    parser.add_argument('--words', type=int, default=0, help='words of text per page')
+    parser.add_argument('--no-pressure', action='store_true', help='draw strokes of constant width')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    width, height = (int(v) for v in args.image_size.split('x'))
+    generate_notebook(args.filename, args.pages, args.seed, strokes=args.strokes, points=args.points,
+                      shapes=args.shapes, images=args.images, image_size=(width, height),
+                      words=args.words, pressure=not args.no_pressure)
+
+
+if __name__ == '__main__':
+    main()
@@ -30,6 +30,9 @@ class Table(ColorTool):
 		s += 'lineColPercent: ' + str(self._lineColPer) + '\n'
 		return s
 
+	def bbox(self):
+		return (min(self._left,self._right),min(self._top,self._bottom),max(self._left,self._right),max(self._top,self._bottom))
+
 	def left(self):
 		return self._left
 
@@ -42,6 +45,12 @@ class Table(ColorTool):
 	def bottom(self):
 		return self._bottom
 
+	def lineRowPer(self):
+		return self._lineRowPer
+
+	def lineColPer(self):
+		return self._lineColPer
+
 	def table_height(self):
 		return self._bottom - self._top
 
@@ -0,0 +1,11 @@
+import os
+import sys
+
+# The backend is imported as the ``backend`` package, as
+# ``mobicloud.backend`` and, for the model base class, as top-level
+# modules (``from color_tool import ...``)
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJECT_DIR = os.path.dirname(BACKEND_DIR)
+for path in (os.path.dirname(PROJECT_DIR), PROJECT_DIR, BACKEND_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,129 @@
+"""
+Round trips of the notes in testing-notes/ through the exporter, the
+page sidecar and the compressed-archive reader
+"""
+
+import glob
+import gzip
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from backend.quill_import import QuillImporter
+from backend.quill_export import QuillExporter
+from backend.page_sidecar import open_sidecar
+
+NOTES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'testing-notes')
+NOTES = sorted(glob.glob(os.path.join(NOTES_DIR, '*.note')))
+
+
+def page_content(page):
+    """
+    Return everything drawn from the page, as plain comparable values
+    """
+    content = [page.aspect_ratio]
+    for stroke in page.strokes:
+        content.append(('stroke', tuple(stroke.rgb()), stroke.thickness(), stroke.has_pressure(),
+                        tuple(stroke.points())))
+    for line in page.lines:
+        content.append(('line', tuple(line.rgb()), line.thickness(), line.x0(), line.y0(), line.x1(), line.y1()))
+    for name in ('rectangles', 'ovals', 'triangles'):
+        for shape in getattr(page, name):
+            content.append((name, tuple(shape.rgb()), shape.thickness(),
+                            shape.left(), shape.right(), shape.top(), shape.bottom()))
+    for table in page.tables:
+        content.append(('table', tuple(table.rgb()), table.thickness(), table.left(), table.right(),
+                        table.top(), table.bottom(), tuple(table.lineRowPer()), tuple(table.lineColPer())))
+    for textbox in page.textboxes:
+        content.append(('textbox', tuple(textbox.rgb()), textbox.left(), textbox.right(), textbox.top(),
+                        textbox.bottom(), textbox.textStr(), textbox.textSize(), bool(textbox.isBold()),
+                        bool(textbox.isItalic()), bool(textbox.isUnderline())))
+    for image in page.images:
+        content.append(('image', image.uuid(), image.x0(), image.x1(), image.y0(), image.y1(),
+                        bool(image.constrain_aspect()), bytes(image.data())))
+    return content
+
+
+def notebook_content(filename):
+    with QuillImporter(filename) as importer:
+        return [page_content(importer.get_page(n)) for n in range(importer.n_pages())]
+
+
+class RoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_notes_found(self):
+        self.assertTrue(NOTES)
+
+    def test_export_import(self):
+        for note in NOTES:
+            with self.subTest(note=os.path.basename(note)):
+                out = os.path.join(self.tmpdir, 'out.note')
+                with QuillImporter(note) as importer:
+                    title = importer.title()
+                    pages = [importer.get_page(n) for n in range(importer.n_pages())]
+                    with QuillExporter(out, title=title) as exporter:
+                        for page in pages:
+                            exporter.add_page(page)
+                    expected = [page_content(page) for page in pages]
+                with QuillImporter(out) as importer:
+                    self.assertEqual(importer.title(), title)
+                    self.assertEqual(importer.uuid(), exporter.uuid.encode('utf-8'))
+                self.assertEqual(notebook_content(out), expected)
+
+    def test_sidecar(self):
+        for note in NOTES:
+            with self.subTest(note=os.path.basename(note)):
+                sidecar = open_sidecar(note, self.tmpdir)
+                with QuillImporter(note) as importer:
+                    self.assertEqual(sidecar.n_pages(), importer.n_pages())
+                    for n in range(importer.n_pages()):
+                        parsed = importer.get_page(n)
+                        loaded = sidecar.get_page(n)
+                        self.assertEqual(loaded.digest, parsed.digest)
+                        self.assertEqual(sidecar.page_digest(n), importer.page_digest(n))
+                        self.assertEqual(page_content(loaded), page_content(parsed))
+
+    def test_export_aborted(self):
+        note = os.path.join(NOTES_DIR, 'demo.note')
+        out = os.path.join(self.tmpdir, 'out.note')
+        shutil.copy(note, out)
+        os.chmod(out, 0o640)
+        with self.assertRaises(RuntimeError):
+            with QuillImporter(note) as importer, QuillExporter(out) as exporter:
+                exporter.add_page(importer.get_page(0))
+                raise RuntimeError('export interrupted')
+        self.assertEqual(os.listdir(self.tmpdir), ['out.note'])
+        self.assertEqual(notebook_content(out), notebook_content(note))
+
+    def test_export_mode(self):
+        out = os.path.join(self.tmpdir, 'out.note')
+        umask = os.umask(0o022)
+        try:
+            with QuillExporter(out):
+                pass
+            self.assertEqual(stat.S_IMODE(os.stat(out).st_mode), 0o644)
+            os.chmod(out, 0o640)
+            with QuillExporter(out):
+                pass
+            self.assertEqual(stat.S_IMODE(os.stat(out).st_mode), 0o640)
+        finally:
+            os.umask(umask)
+
+    def test_compressed_archive(self):
+        note = os.path.join(NOTES_DIR, 'demo.note')
+        compressed = os.path.join(self.tmpdir, 'demo.note')
+        with open(note, 'rb') as src, gzip.open(compressed, 'wb') as dest:
+            shutil.copyfileobj(src, dest)
+        self.assertEqual(notebook_content(compressed), notebook_content(note))
+
+
+if __name__ == '__main__':
+    unittest.main()
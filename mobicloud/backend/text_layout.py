@@ -0,0 +1,109 @@
+"""
+Line breaking for text boxes
+
+Every word of a text is measured once with the context's current font,
+and lines are filled by adding up the advances of the words and of the
+spaces between them instead of measuring each candidate line again. A
+word too wide for a line on its own is split at the longest prefix that
+fits, found by binary search. The resulting lines are memoized, so a
+text box drawn again with the same font and width is not measured at all.
+"""
+
+from backend.lru_cache import SizedLRUCache
+from backend.instrumentation import count
+
+# Upper bound, in bytes, of the memoized line layouts
+LAYOUT_CACHE_BYTES = 4 * 1024 * 1024
+
+
+def layout_size(lines):
+    return sum(len(line) for line in lines) + 64 * (len(lines) + 1)
+
+
+# Lines keyed by (text, face, slant, weight, size, width)
+layout_cache = SizedLRUCache(LAYOUT_CACHE_BYTES, sizeof=layout_size)
+
+
+def tokenize(text):
+    """
+    Split text at every space, keeping the empty words between repeated
+    spaces so that they still take up room on the line
+    """
+    return text.split(' ') if text else []
+
+
+def _split_long_word(text_advance, word, width):
+    """
+    Return the length of the longest prefix of word no wider than
+    width, and at least 1 so that every line makes progress
+    """
+    lo, hi = 1, len(word) - 1
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if text_advance(word[:mid]) <= width:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def break_lines(ctr, words, width):
+    """
+    Return the lines, no wider than width in user units, that words
+    wrap into with the font currently selected on the cairo context ctr
+    """
+    advances = {}
+    calls = [0]
+
+    def text_advance(text):
+        calls[0] += 1
+        return ctr.text_extents(text)[4]
+
+    def measure(word):
+        try:
+            return advances[word]
+        except KeyError:
+            return advances.setdefault(word, text_advance(word))
+
+    space = measure(' ')
+    lines = []
+    line = []
+    line_width = 0.0
+    pending = list(reversed(words))
+    while pending:
+        word = pending.pop()
+        advance = measure(word)
+        if line:
+            if line_width + space + advance <= width:
+                line.append(word)
+                line_width += space + advance
+                continue
+            lines.append(' '.join(line))
+            line = []
+            line_width = 0.0
+        if advance <= width or len(word) <= 1:
+            line.append(word)
+            line_width = advance
+            continue
+        # Over-long word: keep what fits on a line of its own
+        cut = _split_long_word(text_advance, word, width)
+        lines.append(word[:cut])
+        pending.append(word[cut:])
+    if line:
+        lines.append(' '.join(line))
+    count('text_measure', calls[0])
+    return lines
+
+
+def layout_text(ctr, text, face, slant, weight, size, width):
+    """
+    Return the wrapped lines of text, computing them only the first time
+    they are asked for. The font described by face, slant, weight and
+    size must be the one selected on ctr.
+    """
+    key = (text, face, slant, weight, size, width)
+    lines = layout_cache.get(key)
+    if lines is None:
+        lines = tuple(break_lines(ctr, tokenize(text), width))
+        layout_cache.put(key, lines)
+    return lines
@@ -1,6 +1,8 @@
 '''
 class TextBox
 '''
+from backend.text_layout import tokenize
+
 class TextBox(object):
 
 	def __init__(self,red,green,blue,left,right,top,bottom,textStr,textSize,isBold,isItalic,isUnderline):
@@ -31,18 +33,10 @@ class TextBox(object):
 		return s
 
 	def breakWords(self):
-		text = self._textStr
-		list_words = []
-		word = ''
-		for index in range(len(text)):
-			if text[index] != ' ':
-				word += text[index]
-			if word != ' ' and text[index] == ' ':
-				list_words.append(word)
-				word = ''
-			if index == len(text) - 1:
-				list_words.append(word)
-		return list_words
+		return tokenize(self._textStr)
+
+	def bbox(self):
+		return (min(self._left,self._right),min(self._top,self._bottom),max(self._left,self._right),max(self._top,self._bottom))
 
 	def fontScale(self):
 		return self._font_size_scale_factor
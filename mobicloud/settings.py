@@ -123,3 +123,19 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/3.1/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Note rendering
+
+# Upper bound, in bytes, of the encoded page images kept in memory
+NOTE_RENDER_CACHE_BYTES = 64 * 1024 * 1024
+
+# Upper bound, in bytes, of the approximate size of the parsed pages kept in memory
+NOTE_PAGE_CACHE_BYTES = 128 * 1024 * 1024
+
+# Load pages from memory-mapped sidecar files of decoded pages, built on
+# first use, instead of parsing them from the archives
+NOTE_PAGE_SIDECARS = False
+
+# Directory of the sidecar files; by default they are written next to the notes
+NOTE_PAGE_SIDECAR_DIR = None
@@ -4,5 +4,13 @@ from note import views
 
 urlpatterns = [
     path('<imageName>/<int:pageNumber>',views.display_note,name='note-page-display'),
+    path('<imageName>/<int:pageNumber>/image',views.display_page_image,name='note-page-image'),
+    path('<imageName>/<int:pageNumber>/tiles/<int:zoom>/<int:x>/<int:y>.png',views.display_tile,name='note-page-tile'),
+    path('<imageName>/contact-sheet',views.contact_sheet,name='note-contact-sheet'),
+    path('<imageName>/contact-sheet.png',views.contact_sheet_image,name='note-contact-sheet-image'),
+    path('<imageName>.pdf',views.export_pdf,name='note-pdf-export'),
     path('shape',views.draw_shape, name='simple-shape'),
+    path('render-cache',views.render_cache_stats, name='render-cache-stats'),
+    path('page-cache',views.page_cache_stats, name='page-cache-stats'),
+    path('metrics',views.metrics, name='note-metrics'),
 ]
@@ -1,13 +1,25 @@
 
-import base64
+import hashlib
 import os
 import io
+import functools
+import time
+from datetime import datetime, timezone
 from math import pi
 from cairo import SVGSurface
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse, Http404
 from django.shortcuts import render
+from django.urls import reverse
+from django.views.decorators.http import condition
+from django.views.decorators.vary import vary_on_headers
 from backend.quill_import import QuillImporter
-from backend.cairo_context import CairoContext
+from backend.cairo_context import CairoContext, TILE_SIZE, SURFACE_KINDS, CONTENT_TYPES, preferred_kind
+from backend.contact_sheet import render_contact_sheet, contact_sheet_layout, THUMB_WIDTH, THUMB_HEIGHT
+from backend.lru_cache import SizedLRUCache
+from backend.pdf_export import stream_pdf_file
+from backend.page_cache import ParsedPageCache
+from backend.instrumentation import tracing, render_metrics
 from backend import cairodraw
 
 class Shapes(cairodraw.CairoWidget):
@@ -37,19 +49,262 @@ class Shapes(cairodraw.CairoWidget):
         cr.arc(width / 2.0, height / 2.0, radius / 3.0 - 10, pi / 3, 2 * pi / 3)
         cr.stroke()
 
+# Size of the rendered page, in pixels
+PAGE_WIDTH = 410
+PAGE_HEIGHT = 547
+
+# Encoded page images, keyed by (page digest, page number, width, height, format)
+render_cache = SizedLRUCache(getattr(settings, 'NOTE_RENDER_CACHE_BYTES', 64 * 1024 * 1024))
+
+# Parsed pages shared by all requests, keyed by archive path, mtime, size and page
+page_cache = ParsedPageCache(getattr(settings, 'NOTE_PAGE_CACHE_BYTES', 128 * 1024 * 1024),
+							 sidecars=getattr(settings, 'NOTE_PAGE_SIDECARS', False),
+							 sidecar_dir=getattr(settings, 'NOTE_PAGE_SIDECAR_DIR', None))
+
+def render_page(qp,pageNumber,width,height,kind='png'):
+	"""
+	Return the encoded page image, rendering it on a render cache miss.
+
+	The image is deliberately buffered rather than streamed: it has to be
+	complete to go into render_cache, cairo only hands it over once the
+	surface is finished, and a buffered response carries a Content-Length.
+	"""
+	key = (qp.digest, pageNumber, width, height, kind)
+	data = render_cache.get(key)
+	if data is None:
+		buff = io.BytesIO()
+		ctr = CairoContext(buff,width,height,qp,kind=kind)
+		ctr.draw_page()
+		data = ctr.write_to_buff(buff).getvalue()
+		render_cache.put(key, data)
+	return data
+
+def negotiate_format(request):
+	"""
+	Return the output format asked for by the ?format= parameter or
+	the Accept header: one of SURFACE_KINDS, 'auto' to let the page
+	content decide between png and svg, or None if the format is unknown
+	"""
+	kind = request.GET.get('format')
+	if kind is not None:
+		if kind in SURFACE_KINDS or kind == 'auto':
+			return kind
+		return None
+	png = request.accepts(CONTENT_TYPES['png'])
+	svg = request.accepts(CONTENT_TYPES['svg'])
+	if png and svg:
+		return 'auto'
+	if svg:
+		return 'svg'
+	if not png and request.accepts(CONTENT_TYPES['pdf']):
+		return 'pdf'
+	return 'png'
+
+def server_timing(view):
+	"""
+	Answer with a Server-Timing header listing the time spent in each
+	stage of the pipeline during the request and the work it did
+	"""
+	@functools.wraps(view)
+	def wrapper(request,*args,**kwargs):
+		start = time.perf_counter()
+		with tracing() as trace:
+			response = view(request,*args,**kwargs)
+		timing = trace.server_timing()
+		total = 'total;dur=%.2f' % ((time.perf_counter() - start) * 1000)
+		response['Server-Timing'] = timing + ', ' + total if timing else total
+		return response
+	return wrapper
+
+def note_path(imageName):
+	return os.path.join('./backend/testing-notes/',imageName + '.note')
+
+@server_timing
 def display_note(request,imageName,pageNumber):
-	file = os.path.join('./backend/testing-notes/',imageName + '.note')
-	importer = QuillImporter(file)
-	qp = importer.get_page(pageNumber)
-	response = HttpResponse(content_type="image/png")
-	buff = io.BytesIO()
-	ctr = CairoContext(buff,410,547,qp) #(buff,595,795,qp)
-	ctr.draw_page()
-	buff = ctr.write_to_buff(buff)
-	current_page = "<img src='data:image/png;base64," + base64.b64encode(buff.getvalue()).decode() + "'/>"
+	"""
+	Return the page HTML. The page image is rendered by its own request
+	to display_page_image, whose Server-Timing header breaks the render
+	down by stage (compile, draw_stroke, draw_textbox, draw_image,
+	encode, ...); this one only reports its total.
+	"""
+	src = reverse('note-page-image',args=(imageName,pageNumber))
+	current_page = "<img src='" + src + "' width='%d' height='%d'/>" % (PAGE_WIDTH,PAGE_HEIGHT)
 	
 	return render(request,'note.html',{'current_page':current_page})
 
+def page_etag(request,imageName,pageNumber):
+	# Only hashes the page record, so a matching If-None-Match costs no parse or render
+	try:
+		digest = page_cache.page_digest(note_path(imageName),pageNumber)
+	except (OSError, IndexError):
+		return None
+	# The choice made for 'auto' only depends on the page, so it is covered by the digest
+	return '"%s-%d-%dx%d-%s"' % (digest,pageNumber,PAGE_WIDTH,PAGE_HEIGHT,negotiate_format(request))
+
+def page_last_modified(request,imageName,pageNumber):
+	try:
+		mtime = os.stat(note_path(imageName)).st_mtime
+	except OSError:
+		return None
+	return datetime.fromtimestamp(mtime, timezone.utc)
+
+@server_timing
+# Outside condition(), so that 304 responses also vary on Accept and caches
+# keep the formats apart on If-Modified-Since as well as If-None-Match
+@vary_on_headers('Accept')
+@condition(etag_func=page_etag, last_modified_func=page_last_modified)
+def display_page_image(request,imageName,pageNumber):
+	file = note_path(imageName)
+	kind = negotiate_format(request)
+	if kind is None:
+		raise Http404('unknown format')
+	if not os.path.isfile(file):
+		raise Http404('no such notebook')
+	try:
+		qp = page_cache.get_page(file,pageNumber)
+	except IndexError:
+		raise Http404('no such page')
+	if kind == 'auto':
+		kind = preferred_kind(qp,PAGE_WIDTH,PAGE_HEIGHT)
+	data = render_page(qp,pageNumber,PAGE_WIDTH,PAGE_HEIGHT,kind)
+	response = HttpResponse(data, content_type=CONTENT_TYPES[kind])
+	# Let browsers and proxies keep the image, but check the ETag before reuse
+	response['Cache-Control'] = 'no-cache'
+	return response
+
+# Deepest zoom level served by display_tile; the page is 2**zoom tiles high
+MAX_TILE_ZOOM = 6
+
+def tile_etag(request,imageName,pageNumber,zoom,x,y):
+	if zoom > MAX_TILE_ZOOM:
+		return None
+	try:
+		digest = page_cache.page_digest(note_path(imageName),pageNumber)
+	except (OSError, IndexError):
+		return None
+	return '"%s-%d-tile-%d-%d-%d-%d"' % (digest,pageNumber,TILE_SIZE,zoom,x,y)
+
+@condition(etag_func=tile_etag)
+def display_tile(request,imageName,pageNumber,zoom,x,y):
+	if zoom > MAX_TILE_ZOOM:
+		raise Http404('no such tile')
+	try:
+		qp = page_cache.get_page(note_path(imageName),pageNumber)
+	except FileNotFoundError:
+		raise Http404('no such notebook')
+	except IndexError:
+		raise Http404('no such page')
+	columns,rows = CairoContext.tile_grid(qp,zoom)
+	if x >= columns or y >= rows:
+		raise Http404('no such tile')
+	key = (qp.digest, pageNumber, 'tile', TILE_SIZE, zoom, x, y, 'png')
+	png = render_cache.get(key)
+	if png is None:
+		buff = io.BytesIO()
+		ctr = CairoContext(buff,TILE_SIZE,TILE_SIZE,qp)
+		ctr.draw_tile(zoom,x,y)
+		png = ctr.write_to_buff(buff).getvalue()
+		render_cache.put(key, png)
+	response = HttpResponse(png, content_type='image/png')
+	# Every tile is kept by the browser on its own and revalidated by ETag
+	response['Cache-Control'] = 'no-cache'
+	return response
+
+def request_importer(request,imageName):
+	"""
+	Return the QuillImporter of the notebook shared by the ETag function
+	and the view answering the request. It is opened on first use and
+	closed by closes_importers.
+	"""
+	importers = request.__dict__.setdefault('_note_importers',{})
+	importer = importers.get(imageName)
+	if importer is None:
+		importer = importers[imageName] = QuillImporter(note_path(imageName))
+	return importer
+
+def closes_importers(view):
+	"""
+	Close the importers opened by request_importer once the view returns
+	"""
+	@functools.wraps(view)
+	def wrapper(request,*args,**kwargs):
+		try:
+			return view(request,*args,**kwargs)
+		finally:
+			for importer in request.__dict__.pop('_note_importers',{}).values():
+				importer.close()
+	return wrapper
+
+def notebook_digests(request,imageName):
+	"""
+	Return the content digests of the pages of the notebook, or None if
+	there is no such notebook. They are kept by page_cache, so a cached
+	sprite is revalidated without opening the archive.
+	"""
+	file = note_path(imageName)
+	if not os.path.isfile(file):
+		return None
+	return page_cache.page_digests(file,functools.partial(request_importer,request,imageName))
+
+def contact_sheet_etag(request,imageName):
+	digests = notebook_digests(request,imageName)
+	if digests is None:
+		return None
+	return '"%s-%dx%d"' % (hashlib.sha1(' '.join(digests).encode('ascii')).hexdigest(),THUMB_WIDTH,THUMB_HEIGHT)
+
+def contact_sheet(request,imageName):
+	"""
+	Return the URL of the sprite and the position of every thumbnail in it
+	"""
+	file = note_path(imageName)
+	if not os.path.isfile(file):
+		raise Http404('no such notebook')
+	with QuillImporter(file) as importer:
+		width,height,thumbnails = contact_sheet_layout(importer.n_pages())
+	return JsonResponse({
+		'sprite': reverse('note-contact-sheet-image',args=(imageName,)),
+		'width': width,
+		'height': height,
+		'thumbnails': thumbnails,
+	})
+
+@closes_importers
+@condition(etag_func=contact_sheet_etag)
+def contact_sheet_image(request,imageName):
+	# On a miss, digests and thumbnails are read through one importer
+	digests = notebook_digests(request,imageName)
+	if digests is None:
+		raise Http404('no such notebook')
+	key = (digests, 'contact-sheet', THUMB_WIDTH, THUMB_HEIGHT, 'png')
+	png = render_cache.get(key)
+	if png is None:
+		png,thumbnails = render_contact_sheet(request_importer(request,imageName))
+		render_cache.put(key, png)
+	response = HttpResponse(png, content_type='image/png')
+	response['Cache-Control'] = 'no-cache'
+	return response
+
+def export_pdf(request,imageName):
+	file = note_path(imageName)
+	if not os.path.isfile(file):
+		raise Http404('no such notebook')
+	response = StreamingHttpResponse(stream_pdf_file(file), content_type='application/pdf')
+	response['Content-Disposition'] = 'attachment; filename="%s.pdf"' % imageName
+	return response
+
+def render_cache_stats(request):
+	return JsonResponse(render_cache.stats())
+
+def page_cache_stats(request):
+	return JsonResponse(page_cache.stats())
+
+def metrics(request):
+	lines = [render_metrics()]
+	for name,cache in (('render',render_cache),('page',page_cache)):
+		for key,value in cache.stats().items():
+			lines.append('note_cache_%s{cache="%s"} %d\n' % (key,name,value))
+	return HttpResponse(''.join(lines), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 def draw_shape(request):
 	response = HttpResponse(content_type='image/svg+xml')
 	cairodraw.draw_widget(response, Shapes)